@@ -2,14 +2,13 @@
 Admin pages for Cart and Order
 """
 from django import forms
-from django.contrib import admin
-from django.db.models import Sum
+from django.contrib import admin, messages
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
 from django.http import HttpResponseRedirect
 from django.utils.safestring import mark_safe
 
-from easy_thumbnails.templatetags.thumbnail import thumbnail_url
-
-from apps.cart.models import Cart, CartItem, Order, OrderItem
+from apps.cart.models import Cart, CartItem, Order, OrderItem, OutgoingEmail
 
 from utils import (
     set_reserve_for_order_items,
@@ -24,9 +23,26 @@ class OrderItemsInline(admin.TabularInline):
     fields = ('get_image', 'product', 'price')
     readonly_fields = ('get_image',)
 
+    def get_queryset(self, request):
+        # product is needed for the image of every row
+        return super().get_queryset(request).select_related('product')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(
+            db_field, request, **kwargs)
+        if db_field.name == 'product':
+            # products for selects are loaded once for all rows of the page
+            choices = getattr(request, 'order_item_product_choices', None)
+            if choices is None:
+                # (list() would run COUNT query for the length hint)
+                choices = [choice for choice in formfield.choices]
+                request.order_item_product_choices = choices
+            formfield.choices = choices
+        return formfield
+
     def get_image(self, obj):
         """ show image for OrderItem"""
-        url_small = thumbnail_url(obj.product.picture_1, 'small')
+        url_small = obj.product.get_thumbnail_url('small')
         return mark_safe(f'<img src={url_small} alt="small-img">')
     get_image.short_description = 'Image'
 
@@ -40,8 +56,8 @@ class OrderAdmin(admin.ModelAdmin):
     save_on_top = True
 
     # list appearance
-    list_display = ('id', 'status', 'calculate_total', 'created',
-                    'country', 'message', 'updated')
+    list_display = ('id', 'status', 'calculate_total', 'items_count',
+                    'created', 'country', 'message', 'updated')
     list_filter = ('status', 'country')
     # list_editable = ('status',)
     actions = [
@@ -68,11 +84,24 @@ class OrderAdmin(admin.ModelAdmin):
         #     kwargs['widget'] = forms.TextInput(attrs={'size': 20})
         return super().formfield_for_dbfield(db_field, **kwargs)
 
+    def get_queryset(self, request):
+        # total and number of items for all orders of the page in one query
+        return super().get_queryset(request).annotate(
+            total=Coalesce(Sum('items__price'), 0),
+            items_number=Count('items'),
+        )
+
     def calculate_total(self, order):
-        """ Calculate subtotal for order """
-        total = order.items.aggregate(Sum('price'))
-        return total.get('price__sum', 0)
+        """ Subtotal for order (annotated in get_queryset) """
+        return order.total
     calculate_total.short_description = 'Total'
+    calculate_total.admin_order_field = 'total'
+
+    def items_count(self, order):
+        """ Number of items in order (annotated in get_queryset) """
+        return order.items_number
+    items_count.short_description = 'Items'
+    items_count.admin_order_field = 'items_number'
 
     # hide unneeded buttons
     def change_view(self, request, object_id, form_url='', extra_context=None):
@@ -85,38 +114,49 @@ class OrderAdmin(admin.ModelAdmin):
     # define behavior for additional buttons in change Order form
     def response_change(self, request, obj):
         if "_cancel" in request.POST:
-            cancel_order(obj)
+            refused = cancel_order(obj)
         elif "_in_progress" in request.POST:
-            progress_order(obj)
+            refused = progress_order(obj)
         elif "_complete" in request.POST:
-            sell_order(obj)
+            refused = sell_order(obj)
         elif "_reserve" in request.POST:
-            set_reserve_for_order_items(obj)
+            refused = set_reserve_for_order_items(obj)
         else:
             return super().response_change(request, obj)
+        self.message_refused(request, refused)
         return HttpResponseRedirect(".")  # stay on the same detail page
 
+    def message_refused(self, request, refused):
+        """ Warn about Orders which status was not changed"""
+        if refused:
+            self.message_user(
+                request,
+                f'Orders {", ".join(map(str, sorted(refused)))} were not'
+                f' changed: their items are sold or reserved by other orders.',
+                level=messages.ERROR,
+            )
+
     # custom actions for Order list
     def cancel_orders_from_list(self, request, queryset):
         """ Change status to 'CANCELED' for Orders. Remove reserves."""
-        for order in queryset:
-            cancel_order(order)
+        # single transaction with bulk updates for all selected orders
+        self.message_refused(request, cancel_order(queryset))
         self.message_user(
             request, 'Status set to "Canceled". Items unreserved.')
     cancel_orders_from_list.short_description = 'Cancel orders'
 
     def complete_orders_from_list(self, request, queryset):
         """ Change status to 'COMPLETED' for Orders. Remove items from stock"""
-        for order in queryset:
-            sell_order(order)
+        # single transaction with bulk updates for all selected orders
+        self.message_refused(request, sell_order(queryset))
         self.message_user(
             request, 'Status set to "Complete". Items removed from stock.')
     complete_orders_from_list.short_description = 'Complete orders'
 
     def reserve_orders_from_list(self, request, queryset):
         """ Change status to 'RESERVED' for Order and all its Items"""
-        for order in queryset:
-            set_reserve_for_order_items(order)
+        # single transaction with bulk updates for all selected orders
+        self.message_refused(request, set_reserve_for_order_items(queryset))
         self.message_user(request, 'Reserved')
     reserve_orders_from_list.short_description = 'Reserve orders'
 
@@ -128,9 +168,13 @@ class CartItemsInline(admin.TabularInline):
     list_display = ('get_image', 'product', )
     readonly_fields = ('get_image', 'product', 'price')
 
+    def get_queryset(self, request):
+        # product is needed for the image of every row
+        return super().get_queryset(request).select_related('product')
+
     def get_image(self, obj):
         """ Show image for OrderItem"""
-        url_small = thumbnail_url(obj.product.picture_1, 'small')
+        url_small = obj.product.get_thumbnail_url('small')
         return mark_safe(f'<img src={url_small} alt="small-img">')
     get_image.short_description = 'Image'
 
@@ -145,3 +189,22 @@ class CartAdmin(admin.ModelAdmin):
         """ Show human-readable date at list page"""
         return obj.date_created.strftime('%Y-%m-%d')
     view_creation_date.short_description = 'Created'
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    """ E-mails outbox: view sending status and errors"""
+    list_display = ('id', 'subject', 'to', 'status', 'attempts',
+                    'created', 'sent', 'next_attempt')
+    list_filter = ('status',)
+    readonly_fields = ('subject', 'body', 'from_email', 'to',
+                       'content_subtype', 'created', 'sent', 'attempts',
+                       'last_error')
+    fields = (
+        ('subject', 'status'),
+        ('from_email', 'to', 'content_subtype'),
+        ('created', 'sent'),
+        ('attempts', 'next_attempt'),
+        'last_error',
+        'body',
+    )
@@ -0,0 +1,70 @@
+"""
+One-time migration of carts made before cart tokens, when Cart had
+'session' foreign key (the project has no migrations: the schema of
+a new database is made by 'migrate --run-syncdb').
+Adds the token column, the token of an old cart is the session key
+of its visitor: the cart is found by the session cookie and gets
+the cart cookie on the first visit (see utils.get_cart).
+date_updated of an old cart is the last activity of its session
+(expiry of the session minus its age), so purge_stale_carts keeps
+carts of active visitors (carts of deleted sessions keep date_updated).
+Carts without session get random tokens.
+The old session_id column is not used anymore (dropped by SQLite table
+rebuild, left for other databases).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.db.models import Exists, ExpressionWrapper, OuterRef, Subquery
+
+from apps.cart.models import Cart
+from apps.cart.models.cart import new_cart_token
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Give carts made before cart tokens their tokens'
+
+    def handle(self, *args, **options):
+        table = Cart._meta.db_table
+        with connection.cursor() as cursor:
+            columns = {column.name for column in
+                       connection.introspection.get_table_description(
+                           cursor, table)}
+        if 'token' in columns:
+            self.stdout.write('Carts already have tokens.')
+            return
+        # nullable and not unique while tokens are filled
+        temporary = models.CharField(max_length=43, null=True)
+        temporary.set_attributes_from_name('token')
+        # one transaction (the schema editor is atomic, like migrations)
+        with connection.schema_editor() as editor:
+            editor.add_field(Cart, temporary)
+            migrated = self.copy_session_keys(table)
+            generated = self.generate_tokens()
+            editor.alter_field(Cart, temporary, Cart._meta.get_field('token'))
+        self.stdout.write(f'Tokens from sessions: {migrated}, '
+                          f'new tokens: {generated}')
+
+    def copy_session_keys(self, table):
+        # the model has no session field anymore
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table} SET token = session_id '
+                           f'WHERE session_id IS NOT NULL')
+        sessions = Session.objects.filter(session_key=OuterRef('token'))
+        return Cart.objects.filter(Exists(sessions)).update(
+            date_updated=ExpressionWrapper(
+                Subquery(sessions.values('expire_date'))
+                - timedelta(seconds=settings.SESSION_COOKIE_AGE),
+                output_field=models.DateTimeField()))
+
+    def generate_tokens(self):
+        carts = [Cart(pk=pk, token=new_cart_token()) for pk in
+                 Cart.objects.filter(token__isnull=True)
+                 .values_list('pk', flat=True)]
+        Cart.objects.bulk_update(carts, ['token'], batch_size=BATCH_SIZE)
+        return len(carts)
@@ -0,0 +1,123 @@
+"""
+Retention of carts and sessions: every visitor who added a product has
+a Cart (and had a Session before cart cookies), nothing else ever
+deletes them.
+The command deletes expired sessions and then abandoned carts: 'NEW'
+carts not updated for CART_RETENTION. The cart cookie renews date_updated
+of the cart (see apps/cart/middleware.py), so with the default retention
+(cart cookie age) nobody can reach such carts anymore. Cart of an Order
+is never deleted, such abandoned cart is marked 'OLD'.
+Rows are deleted in batches of --batch-size, every batch in its own
+short transaction, so locks are never held for long
+(unlike 'clearsessions': one DELETE of all expired sessions). A cart
+updated or ordered while its batch is purged is kept.
+Run periodically (cron).
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from apps.cart.middleware import cart_cookie_age
+from apps.cart.models import Cart, CartItem, Order
+
+# sessions stored by these engines are purged
+DB_SESSION_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+)
+
+
+def cart_retention():
+    """ Abandoned cart is kept this long after its last update"""
+    days = getattr(settings, 'CART_RETENTION_DAYS', None)
+    if days is None:
+        return timedelta(seconds=cart_cookie_age())
+    return timedelta(days=days)
+
+
+def purge_sessions_batch(now, batch_size):
+    """ Delete a batch of expired sessions.
+    Returns number of deleted sessions"""
+    keys = list(
+        Session.objects.filter(expire_date__lt=now)
+        .values_list('pk', flat=True)[:batch_size]
+    )
+    if not keys:
+        return 0
+    Session.objects.filter(pk__in=keys).delete()
+    return len(keys)
+
+
+def abandoned_carts(now):
+    return Cart.objects.filter(
+        status='NEW', date_updated__lt=now - cart_retention())
+
+
+def purge_carts_batch(now, batch_size):
+    """ Delete a batch of abandoned carts with their items,
+    mark ordered ones 'OLD'. Returns numbers (carts, items)"""
+    carts = list(
+        abandoned_carts(now)
+        .annotate(ordered=Exists(Order.objects.filter(cart=OuterRef('pk'))))
+        .values_list('pk', 'ordered')[:batch_size]
+    )
+    if not carts:
+        return 0, 0
+    ordered_ids = [pk for pk, ordered in carts if ordered]
+    deleted_ids = [pk for pk, ordered in carts if not ordered]
+    # a cart may be renewed or ordered since it was selected:
+    # the conditions are checked again in the transaction
+    abandoned = abandoned_carts(now)
+    with transaction.atomic():
+        marked = abandoned.filter(pk__in=ordered_ids).update(status='OLD')
+        # locked: no order or item of these carts until the commit
+        # (delete() of a queryset doesn't lock its rows)
+        deleted_ids = list(
+            abandoned.filter(pk__in=deleted_ids)
+            .exclude(Exists(Order.objects.filter(cart=OuterRef('pk'))))
+            .select_for_update().values_list('pk', flat=True))
+        # items are deleted by one DELETE ... WHERE cart_id IN (...)
+        _, deleted = Cart.objects.filter(pk__in=deleted_ids).delete()
+    return marked + len(deleted_ids), deleted.get(CartItem._meta.label, 0)
+
+
+class Command(BaseCommand):
+    help = 'Delete expired sessions and abandoned carts in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--pause', type=float, default=0.05,
+            help='Seconds between batches: other transactions go first')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if settings.SESSION_ENGINE in DB_SESSION_ENGINES:
+            self.purge('Sessions', lambda: (
+                purge_sessions_batch(now, options['batch_size']), ),
+                options)
+        self.purge('Carts, items', lambda: purge_carts_batch(
+            now, options['batch_size']), options)
+
+    def purge(self, title, purge_batch, options):
+        """ Run batches until nothing is left, report rows/sec"""
+        started = time.monotonic()
+        totals = None
+        while True:
+            numbers = purge_batch()
+            totals = (numbers if totals is None
+                      else tuple(map(sum, zip(totals, numbers))))
+            if numbers[0] < options['batch_size']:
+                break
+            time.sleep(options['pause'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'{title}: {", ".join(map(str, totals))} '
+            f'in {elapsed:.1f} s ({sum(totals) / max(elapsed, 1e-6):.0f} '
+            f'rows/s)')
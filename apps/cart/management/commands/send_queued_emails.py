@@ -0,0 +1,108 @@
+"""
+Worker sending e-mails from the outbox (OutgoingEmail).
+All messages of a batch go through one SMTP connection.
+Failed messages are retried with exponential backoff.
+Run periodically (cron) or permanently with --loop.
+"""
+import time
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.cart.models import OutgoingEmail
+
+# seconds: delay after the 1st failure, doubled for every next one
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 6
+# seconds: claimed messages are not taken by other workers meanwhile
+# (and are taken again if this worker dies)
+CLAIM_TIMEOUT = 600
+
+
+def claim_batch(batch_size):
+    """ Take due pending messages for this worker (short transaction)"""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt__lte=now)
+            .order_by('next_attempt')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=ids).update(
+            attempts=F('attempts') + 1,
+            next_attempt=now + timedelta(seconds=CLAIM_TIMEOUT),
+        )
+    return list(OutgoingEmail.objects.filter(pk__in=ids))
+
+
+def mark_failed(email, error):
+    """ Schedule the next attempt or give up"""
+    delay = min(RETRY_DELAY * 2 ** (email.attempts - 1), MAX_RETRY_DELAY)
+    email.last_error = str(error)
+    email.next_attempt = timezone.now() + timedelta(seconds=delay)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = 'FAILED'
+    email.save(update_fields=['last_error', 'next_attempt', 'status'])
+
+
+def send_batch(batch_size):
+    """ Send a batch of due messages. Returns (sent, failed)"""
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+    sent_ids = []
+    failed = 0
+    connection = get_connection()
+    try:
+        # one connection (SMTP + TLS handshake) for the whole batch
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            mark_failed(email, error)
+        return 0, len(emails)
+    try:
+        for email in emails:
+            try:
+                message = email.to_message(connection)
+                # a backend with fail_silently returns 0 instead of raising
+                if not connection.send_messages([message]):
+                    raise RuntimeError('Not sent by the e-mail backend')
+            except Exception as error:
+                mark_failed(email, error)
+                failed += 1
+            else:
+                sent_ids.append(email.pk)
+    finally:
+        connection.close()
+    OutgoingEmail.objects.filter(pk__in=sent_ids).update(
+        status='SENT', sent=timezone.now(), last_error=None)
+    return len(sent_ids), failed
+
+
+class Command(BaseCommand):
+    help = 'Send e-mails queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running and check the outbox every --interval seconds')
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent: {sent}, failed: {failed}')
+            # full batch: there may be more due messages right now
+            if sent + failed >= options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,91 @@
+"""
+Cart identity without sessions: the opaque token of the visitor's cart
+in a signed cookie. Visitors have no session at all, so read-only pages
+write nothing (no session UPDATE on every request, as it was with
+SESSION_SAVE_EVERY_REQUEST).
+The cookie is set when the cart is created and renewed only when less
+than CART_COOKIE_REFRESH seconds of its lifetime are left: then
+date_updated of the cart is moved too (activity mark for
+purge_stale_carts) - one write in weeks instead of one per page.
+"""
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+from apps.cart.models import Cart
+
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_SALT = 'apps.cart.token'
+
+
+def cart_cookie_age():
+    """ Lifetime of cart cookie (seconds)"""
+    return getattr(settings, 'CART_COOKIE_AGE', settings.SESSION_COOKIE_AGE)
+
+
+def cart_cookie_refresh():
+    """ Cookie is renewed when less than this lifetime is left (seconds)"""
+    return getattr(settings, 'CART_COOKIE_REFRESH', cart_cookie_age() // 2)
+
+
+def _signer():
+    # the same signer as of HttpResponse.set_signed_cookie()
+    return signing.get_cookie_signer(salt=CART_COOKIE_NAME + CART_COOKIE_SALT)
+
+
+def sign_cart_token(token, issued=None):
+    """ Value of cart cookie: token and its issue time, signed"""
+    if issued is None:
+        issued = int(time.time())
+    return _signer().sign(f'{token}:{issued}')
+
+
+def read_cart_cookie(request):
+    """ (token, issue time) from cart cookie of the request,
+    (None, None) for missing, forged or expired cookie"""
+    try:
+        value = _signer().unsign(
+            request.COOKIES[CART_COOKIE_NAME], max_age=cart_cookie_age())
+        token, issued = value.rsplit(':', 1)
+        return token, int(issued)
+    except (KeyError, signing.BadSignature, ValueError):
+        return None, None
+
+
+def set_cart_cookie(response, token):
+    response.set_cookie(
+        CART_COOKIE_NAME, sign_cart_token(token),
+        max_age=cart_cookie_age(),
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+
+
+class CartCookieMiddleware:
+    """ request.cart_token from cart cookie, views set a new one with
+    request.cart_token_changed (see utils.get_or_create_cart)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token, issued = read_cart_cookie(request)
+        request.cart_token = token
+        request.cart_token_changed = False
+        response = self.get_response(request)
+        if request.cart_token_changed:
+            set_cart_cookie(response, request.cart_token)
+        elif token and (issued + cart_cookie_age() - time.time()
+                        < cart_cookie_refresh()):
+            if Cart.objects.filter(token=token, status='NEW').update(
+                    date_updated=timezone.now()):
+                set_cart_cookie(response, token)
+            else:
+                # the cart was ordered or purged
+                response.delete_cookie(
+                    CART_COOKIE_NAME,
+                    samesite=settings.SESSION_COOKIE_SAMESITE)
+        return response
@@ -3,10 +3,12 @@ Models for managing products in shopping carts and orders in the web shop
 """
 from .cart import Cart, CartItem
 from .order import Order, OrderItem
+from .outbox import OutgoingEmail
 
 __all__ = (
     'Cart',
     'CartItem',
     'Order',
     'OrderItem',
+    'OutgoingEmail',
 )
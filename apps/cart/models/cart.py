@@ -1,19 +1,27 @@
 """
 Models Cart and CartItem for managing shopping carts and sales.
-Cart is associated with a session instance and contains CartItems,
+Cart is found by its opaque token kept in a signed cookie of the visitor
+(see apps/cart/middleware.py) and contains CartItems,
 each representing a product with a fixed price.
 """
+import secrets
 
-
-from django.contrib.sessions.models import Session
 from django.db import models
 
 from apps.catalog.models import Product
 
 
+def new_cart_token():
+    """ Random token of a cart (unguessable, 32 characters)"""
+    return secrets.token_urlsafe(24)
+
+
 class Cart(models.Model):
-    """A cart of products connected to a user by Session"""
-    session = models.ForeignKey(Session, on_delete=models.SET_NULL, null=True)
+    """A cart of products connected to a visitor by token in cookie"""
+    # carts made before tokens: the session key of the visitor
+    # (see migrate_cart_tokens command)
+    token = models.CharField(
+        max_length=43, unique=True, default=new_cart_token, editable=False)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -25,9 +33,25 @@ class Cart(models.Model):
     status = models.CharField(
         max_length=5, default='NEW', choices=CART_STATUSES)
 
+    class Meta:
+        indexes = [
+            # purge of abandoned carts (purge_stale_carts);
+            # cart of the visitor is found by unique index of token
+            models.Index(fields=['status', 'date_updated'],
+                         name='cart_status_updated_idx'),
+        ]
+
 
 class CartItem(models.Model):
     """A product within a cart with a fixed price."""
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     price = models.IntegerField(default=0, blank=False)
+
+    class Meta:
+        constraints = [
+            # every product is in a cart once: adding is an idempotent
+            # INSERT ... ON CONFLICT DO NOTHING (see utils.add_to_cart)
+            models.UniqueConstraint(
+                fields=['cart', 'product'], name='cart_item_unique_product'),
+        ]
@@ -0,0 +1,68 @@
+"""
+Model OutgoingEmail - durable queue (outbox) of e-mails.
+Messages are written in the same transaction as the data they are about
+(e.g. Order) and sent later by 'send_queued_emails' management command,
+so users never wait for the mail server.
+"""
+from django.core.mail import EmailMessage
+from django.db import models
+from django.utils import timezone
+
+
+class OutgoingEmail(models.Model):
+    """An e-mail waiting to be sent by the worker."""
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, null=True, blank=True)
+    to = models.JSONField(default=list)
+    # 'plain' or 'html'
+    content_subtype = models.CharField(max_length=10, default='plain')
+
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    EMAIL_STATUSES = [
+        ('PENDING', 'Waiting for sending'),
+        ('SENT', 'Sent'),
+        ('FAILED', 'Failed (no more attempts)'),
+    ]
+    status = models.CharField(
+        max_length=10, default='PENDING', choices=EMAIL_STATUSES)
+    # sending attempts made and time of the next one (retry with backoff)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['next_attempt', ]
+        indexes = [
+            # worker: pending messages which are due
+            models.Index(fields=['status', 'next_attempt'],
+                         name='outgoing_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)}'
+
+    @classmethod
+    def queue(cls, message):
+        """ Put EmailMessage to the outbox instead of message.send()"""
+        return cls.objects.create(
+            subject=message.subject,
+            body=message.body,
+            from_email=message.from_email,
+            to=list(message.to),
+            content_subtype=message.content_subtype,
+        )
+
+    def to_message(self, connection=None):
+        """ EmailMessage to be sent with the given connection"""
+        message = EmailMessage(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=self.to,
+            connection=connection,
+        )
+        message.content_subtype = self.content_subtype
+        return message
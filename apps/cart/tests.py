@@ -0,0 +1,507 @@
+"""
+Tests for checkout: no bead is sold twice, constant number of queries;
+JSON API of cart; cart cookie; outbox of e-mails;
+purge of stale carts and sessions
+"""
+import io
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import (
+    TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.cart.middleware import (
+    CART_COOKIE_NAME, cart_cookie_age, cart_cookie_refresh, sign_cart_token,
+)
+from apps.cart.management.commands import (
+    send_queued_emails as outbox_worker,
+)
+from apps.cart.management.commands.purge_stale_carts import (
+    purge_carts_batch,
+)
+from apps.cart.models import Cart, CartItem, Order, OrderItem, OutgoingEmail
+from apps.catalog.models import Product
+from apps.catalog.models.product import ProductQuerySet
+from utils import (
+    CHECKOUT_ATTEMPTS, CheckoutConflict, cancel_order, checkout_cart,
+    set_reserve_for_order_items,
+)
+
+ORIGINAL_UPDATE = ProductQuerySet.update
+
+
+def make_products(number):
+    """ Products without pictures (no thumbnails generation)"""
+    return Product.objects.bulk_create(
+        Product(title=f'Bead {i}', slug=f'bead-{i}', base_price=10 + i)
+        for i in range(number)
+    )
+
+
+def make_cart(products):
+    cart = Cart.objects.create()
+    CartItem.objects.bulk_create(
+        CartItem(cart=cart, product=product, price=product.price)
+        for product in products
+    )
+    return cart
+
+
+def checkout(cart):
+    return checkout_cart(
+        cart, customer_email='buyer@example.com', country='Uruguay')
+
+
+class CheckoutTest(TestCase):
+    """ Checkout of one cart after another"""
+
+    def test_constant_number_of_queries(self):
+        products = make_products(30)
+        for size in (1, 5, 30):
+            Product.objects.update(reserved=False)
+            cart = make_cart(products[:size])
+            # 7 queries and a savepoint (test case is in a transaction)
+            with self.subTest(size=size), self.assertNumQueries(9):
+                order, lost_ids = checkout(cart)
+            self.assertEqual(order.items.count(), size)
+            self.assertEqual(lost_ids, set())
+
+    def test_taken_products_are_lost(self):
+        first, shared, last = make_products(3)
+        first_order, _ = checkout(make_cart([first, shared]))
+        second_order, lost_ids = checkout(make_cart([shared, last]))
+        self.assertEqual(lost_ids, {shared.pk})
+        self.assertEqual(
+            list(second_order.items.values_list('product_id', flat=True)),
+            [last.pk])
+
+    def test_cart_is_ordered_once(self):
+        cart = make_cart(make_products(2))
+        order, _ = checkout(cart)
+        self.assertIsNotNone(order)
+        self.assertEqual(checkout(cart), (None, set()))
+
+
+class OrderStatusTest(TestCase):
+    """ Status changes of orders reserve and release their products,
+    a product is never held by two orders"""
+
+    def make_order(self, products, status):
+        order = Order.objects.create(
+            customer_email='buyer@example.com', country='Uruguay',
+            status=status)
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, price=product.price)
+            for product in products
+        )
+        return order
+
+    def assert_reserved(self, product, reserved):
+        product.refresh_from_db()
+        self.assertEqual(product.reserved, reserved)
+
+    def test_reserve_canceled_order_of_taken_product(self):
+        bead, = make_products(1)
+        canceled = self.make_order([bead], 'CANCELED')
+        self.make_order([bead], 'RESERVED')
+        Product.objects.filter(pk=bead.pk).update(reserved=True)
+        self.assertEqual(set_reserve_for_order_items(canceled),
+                         {canceled.pk})
+        self.assertEqual(canceled.status, 'CANCELED')
+        canceled.refresh_from_db()
+        self.assertEqual(canceled.status, 'CANCELED')
+        self.assert_reserved(bead, True)
+
+    def test_cancel_canceled_order(self):
+        bead, = make_products(1)
+        canceled = self.make_order([bead], 'CANCELED')
+        self.make_order([bead], 'RESERVED')
+        Product.objects.filter(pk=bead.pk).update(reserved=True)
+        self.assertEqual(cancel_order(canceled), set())
+        # the reserve of the other order is kept
+        self.assert_reserved(bead, True)
+
+    def test_orders_of_one_product_in_batch(self):
+        bead, other = make_products(2)
+        first = self.make_order([bead, other], 'NEW')
+        second = self.make_order([bead], 'NEW')
+        refused = set_reserve_for_order_items(
+            Order.objects.filter(pk__in=[first.pk, second.pk]))
+        self.assertEqual(refused, {second.pk})
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {first.pk: 'RESERVED', second.pk: 'NEW'})
+        self.assert_reserved(bead, True)
+        self.assert_reserved(other, True)
+
+    def test_tutorials_are_not_reserved(self):
+        tutorial, = make_products(1)
+        Product.objects.filter(pk=tutorial.pk).update(is_tutorial=True)
+        orders = [self.make_order([tutorial], 'NEW') for _ in range(2)]
+        self.assertEqual(set_reserve_for_order_items(
+            Order.objects.filter(pk__in=[order.pk for order in orders])),
+            set())
+        self.assertEqual(
+            Order.objects.filter(status='RESERVED').count(), 2)
+        self.assert_reserved(tutorial, False)
+
+
+class CartApiTest(TestCase):
+    """ JSON endpoints answer with the new state of cart"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first, cls.second, cls.reserved = make_products(3)
+        cls.reserved.reserved = True
+        cls.reserved.save()
+
+    def post(self, action, product):
+        return self.client.post(f'/api/cart/{action}/', {'product_pk': product})
+
+    def test_add_is_idempotent(self):
+        self.post('add', self.first.pk)
+        state = self.post('add', self.first.pk).json()
+        self.assertEqual(state, {'product_ids': [self.first.pk], 'count': 1,
+                                 'subtotal': self.first.price})
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_state(self):
+        self.assertEqual(self.client.get('/api/cart/').json()['count'], 0)
+        for product in (self.first, self.second, self.reserved):
+            self.post('add', product.pk)
+        state = self.client.get('/api/cart/').json()
+        self.assertEqual(state['product_ids'],
+                         [self.first.pk, self.second.pk, self.reserved.pk])
+        # reserved product is not available: not in subtotal
+        self.assertEqual(state['subtotal'],
+                         self.first.price + self.second.price)
+
+    def test_remove(self):
+        self.post('add', self.first.pk)
+        self.post('add', self.second.pk)
+        state = self.post('remove', self.first.pk).json()
+        self.assertEqual(state['product_ids'], [self.second.pk])
+        # not in cart: nothing to do
+        self.assertEqual(self.post('remove', self.first.pk).json(), state)
+
+    def test_errors(self):
+        self.assertEqual(self.post('add', 0).status_code, 404)
+        self.assertEqual(self.post('add', 'x').status_code, 404)
+        self.assertEqual(self.client.get('/api/cart/add/').status_code, 405)
+
+
+class CartCookieTest(TestCase):
+    """ Cart is kept by signed cart cookie: no session, no writes
+    on read-only pages, the cookie is renewed only when it gets old"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.bead, = make_products(1)
+
+    def add(self):
+        return self.client.post('/api/cart/add/', {'product_pk': self.bead.pk})
+
+    def test_read_only_pages_write_nothing(self):
+        self.assertIn(CART_COOKIE_NAME, self.add().cookies)
+        for url in ('/', '/api/cart/', '/cart/'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(CART_COOKIE_NAME, response.cookies)
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+            self.assertEqual(
+                [query['sql'] for query in queries
+                 if not query['sql'].startswith('SELECT')], [])
+        self.assertFalse(Session.objects.exists())
+
+    def test_forged_cookie(self):
+        self.add()
+        self.client.cookies[CART_COOKIE_NAME] = Cart.objects.get().token
+        self.assertEqual(self.client.get('/api/cart/').json()['count'], 0)
+
+    def test_refresh(self):
+        self.add()
+        cart = Cart.objects.get()
+        Cart.objects.update(date_updated=timezone.now() - timedelta(days=40))
+        issued = time.time() - cart_cookie_age() + cart_cookie_refresh() - 1
+        self.client.cookies[CART_COOKIE_NAME] = sign_cart_token(
+            cart.token, int(issued))
+        response = self.client.get('/api/cart/')
+        self.assertEqual(response.json()['count'], 1)
+        self.assertIn(CART_COOKIE_NAME, response.cookies)
+        cart.refresh_from_db()
+        self.assertGreater(cart.date_updated,
+                           timezone.now() - timedelta(minutes=1))
+        # renewed cookie: nothing to do
+        self.assertNotIn(CART_COOKIE_NAME,
+                         self.client.get('/api/cart/').cookies)
+
+    def test_cookie_of_ordered_cart_is_deleted(self):
+        self.add()
+        Cart.objects.update(status='OLD')
+        issued = time.time() - cart_cookie_age() + 60
+        self.client.cookies[CART_COOKIE_NAME] = sign_cart_token(
+            Cart.objects.get().token, int(issued))
+        response = self.client.get('/api/cart/')
+        self.assertEqual(response.cookies[CART_COOKIE_NAME].value, '')
+
+    def test_cart_of_session(self):
+        # cart made before tokens (see migrate_cart_tokens)
+        cart = make_cart([self.bead])
+        Cart.objects.filter(pk=cart.pk).update(token='session-key')
+        Session.objects.create(
+            session_key='session-key', session_data='',
+            expire_date=timezone.now() + timedelta(days=1))
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = 'session-key'
+        response = self.client.get('/api/cart/')
+        self.assertEqual(response.json()['product_ids'], [self.bead.pk])
+        self.assertIn(CART_COOKIE_NAME, response.cookies)
+
+    def test_forged_session_cookie(self):
+        """ The session cookie opens only the cart of a live session,
+        not any cart by its token"""
+        cart = make_cart([self.bead])
+        Session.objects.create(
+            session_key='expired-key', session_data='',
+            expire_date=timezone.now() - timedelta(days=1))
+        for token in (cart.token, 'expired-key'):
+            Cart.objects.filter(pk=cart.pk).update(token=token)
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = token
+            response = self.client.get('/api/cart/')
+            self.assertEqual(response.json()['product_ids'], [])
+            self.assertNotIn(CART_COOKIE_NAME, response.cookies)
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OutboxTest(TestCase):
+    """ Worker of the outbox sends queued messages in batches,
+    retries failed ones with backoff"""
+
+    def queue(self, number):
+        return [OutgoingEmail.queue(EmailMessage(
+            f'Order {i}', 'Thank you', 'shop@example.com',
+            [f'buyer{i}@example.com'])) for i in range(number)]
+
+    def send(self, batch_size=50):
+        output = io.StringIO()
+        call_command('send_queued_emails', '--batch-size', str(batch_size),
+                     stdout=output)
+        return output.getvalue()
+
+    def test_send(self):
+        self.queue(5)
+        with mock.patch.object(outbox_worker, 'get_connection',
+                               wraps=get_connection) as connections:
+            self.assertIn('Sent: 2, failed: 0', self.send(batch_size=2))
+        # one connection per batch: 2 + 2 + 1
+        self.assertEqual(connections.call_count, 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            OutgoingEmail.objects.filter(status='SENT').count(), 5)
+        self.assertEqual(self.send(), '')
+
+    def test_backoff(self):
+        email, = self.queue(1)
+        with mock.patch.object(EmailBackend, 'send_messages',
+                               side_effect=OSError('refused')):
+            self.assertIn('Sent: 0, failed: 1', self.send())
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error),
+                         ('PENDING', 1, 'refused'))
+        delay = email.next_attempt - timezone.now()
+        self.assertAlmostEqual(delay.total_seconds(),
+                               outbox_worker.RETRY_DELAY, delta=5)
+        # not due yet
+        self.assertEqual(self.send(), '')
+
+    def test_not_sent_silently(self):
+        email, = self.queue(1)
+        with mock.patch.object(EmailBackend, 'send_messages',
+                               return_value=0):
+            self.send()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('PENDING', 1))
+
+    def test_failed(self):
+        email, = self.queue(1)
+        OutgoingEmail.objects.update(
+            attempts=outbox_worker.MAX_ATTEMPTS - 1)
+        with mock.patch.object(EmailBackend, 'send_messages',
+                               side_effect=OSError('refused')):
+            self.send()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts),
+                         ('FAILED', outbox_worker.MAX_ATTEMPTS))
+
+    def test_claim_timeout(self):
+        self.queue(2)
+        self.assertEqual(len(outbox_worker.claim_batch(10)), 2)
+        # claimed by a worker which died: taken after CLAIM_TIMEOUT only
+        self.assertEqual(outbox_worker.claim_batch(10), [])
+        with mock.patch.object(
+                timezone, 'now', return_value=timezone.now() + timedelta(
+                    seconds=outbox_worker.CLAIM_TIMEOUT + 1)):
+            claimed = outbox_worker.claim_batch(10)
+        self.assertEqual([email.attempts for email in claimed], [2, 2])
+
+
+class PurgeTest(TestCase):
+    """ Expired sessions and abandoned carts are deleted,
+    carts of active visitors and of orders are kept"""
+
+    def make_old_cart(self, products, days=365):
+        cart = make_cart(products)
+        # long ago: auto_now is not applied by .update()
+        Cart.objects.filter(pk=cart.pk).update(
+            date_updated=timezone.now() - timedelta(days=days))
+        return cart
+
+    def test_purge(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            Session(session_key=f'key{i}', session_data='',
+                    expire_date=now + timedelta(days=-1 if i else 1))
+            for i in range(7))
+        products = make_products(3)
+        abandoned = [self.make_old_cart(products) for _ in range(5)]
+        ordered = self.make_old_cart(products[:1])
+        Order.objects.create(cart=ordered, customer_email='a@example.com',
+                             country='Uruguay')
+        alive = self.make_old_cart(products, days=10)
+
+        output = io.StringIO()
+        call_command('purge_stale_carts', '--batch-size', '2',
+                     '--pause', '0', stdout=output)
+
+        self.assertEqual(list(Session.objects.values_list('pk', flat=True)),
+                         ['key0'])
+        self.assertFalse(Cart.objects.filter(
+            pk__in=[cart.pk for cart in abandoned]).exists())
+        self.assertEqual(CartItem.objects.filter(cart=alive).count(), 3)
+        self.assertEqual(Cart.objects.get(pk=ordered.pk).status, 'OLD')
+        self.assertIn('Sessions: 6', output.getvalue())
+        self.assertIn('Carts, items: 6, 15', output.getvalue())
+
+
+    def test_changed_while_purged(self):
+        """ Carts ordered or renewed after the batch was selected
+        are kept"""
+        products = make_products(2)
+        ordered, renewed, abandoned = (
+            self.make_old_cart(products) for _ in range(3))
+        atomic = transaction.atomic
+
+        def concurrent_changes(*args, **kwargs):
+            Order.objects.create(cart=ordered, customer_email='a@example.com',
+                                 country='Uruguay')
+            Cart.objects.filter(pk=renewed.pk).update(
+                date_updated=timezone.now())
+            return atomic(*args, **kwargs)
+
+        with mock.patch.object(transaction, 'atomic',
+                               side_effect=concurrent_changes):
+            numbers = purge_carts_batch(timezone.now(), 10)
+        self.assertEqual(numbers, (1, 2))
+        self.assertEqual(
+            set(Cart.objects.values_list('pk', 'status')),
+            {(ordered.pk, 'NEW'), (renewed.pk, 'NEW')})
+        self.assertFalse(Cart.objects.filter(pk=abandoned.pk).exists())
+
+class CheckoutRetryTest(TransactionTestCase):
+    """ Without row locks (SQLite) products may be taken by a concurrent
+    checkout between SELECT and UPDATE: the reserve UPDATE changes fewer
+    rows, the attempt is rolled back and repeated"""
+
+    def setUp(self):
+        self.products = make_products(3)
+        self.cart = make_cart(self.products)
+        self.short_updates = 0
+
+    def update(self, queryset, **kwargs):
+        """ The first short_updates reserve UPDATEs of checkout miss
+        a row, as if a product was reserved by another checkout"""
+        changed = ORIGINAL_UPDATE(queryset, **kwargs)
+        if kwargs.get('reserved') is True and self.short_updates:
+            self.short_updates -= 1
+            return changed - 1
+        return changed
+
+    def concurrent_checkout(self, delay):
+        """ Another checkout commits between the attempts"""
+        ORIGINAL_UPDATE(Product.objects.filter(pk=self.products[0].pk),
+                        reserved=True)
+
+    def checkout(self, short_updates):
+        self.short_updates = short_updates
+        with mock.patch.object(ProductQuerySet, 'update', autospec=True,
+                               side_effect=self.update), \
+                mock.patch('utils.time.sleep',
+                           side_effect=self.concurrent_checkout):
+            return checkout(self.cart)
+
+    def test_retry(self):
+        order, lost_ids = self.checkout(short_updates=1)
+        self.assertEqual(lost_ids, {self.products[0].pk})
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', flat=True)),
+            [product.pk for product in self.products[1:]])
+        self.assertEqual(Product.objects.filter(reserved=True).count(), 3)
+
+    def test_conflict(self):
+        with self.assertRaises(CheckoutConflict):
+            self.checkout(short_updates=CHECKOUT_ATTEMPTS)
+        # every attempt was rolled back
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).status, 'NEW')
+        self.assertEqual(
+            list(Product.objects.filter(reserved=True)
+                 .values_list('pk', flat=True)),
+            [self.products[0].pk])
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCheckoutTest(TransactionTestCase):
+    """ Concurrent checkouts of carts with the same bead"""
+    BUYERS = 8
+
+    def test_bead_is_sold_once(self):
+        bead, = make_products(1)
+        carts = [make_cart([bead]) for _ in range(self.BUYERS)]
+        barrier = threading.Barrier(self.BUYERS)
+        results = []
+
+        def buy(cart):
+            try:
+                barrier.wait()
+                results.append(checkout(cart))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(cart,))
+                   for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        orders = [order for order, _ in results if order is not None]
+        self.assertEqual(len(results), self.BUYERS)
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(OrderItem.objects.filter(product=bead).count(), 1)
+        self.assertTrue(Product.objects.get(pk=bead.pk).reserved)
+        for order, lost_ids in results:
+            if order is None:
+                self.assertEqual(lost_ids, {bead.pk})
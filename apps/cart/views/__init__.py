@@ -1,10 +1,16 @@
 from .cart import CartView
 from .add_remove import add_item, remove_item
+from .api import cart_add, cart_remove, cart_state
 from .make_order import make_order_from_cart
+from .personal import personal_fragment
 
 __all__ = (
     'CartView',
     'add_item',
     'remove_item',
+    'cart_add',
+    'cart_remove',
+    'cart_state',
     'make_order_from_cart',
+    'personal_fragment',
 )
@@ -9,28 +9,24 @@ from apps.cart.models import CartItem
 
 from apps.catalog.models import Product
 
-from utils import get_or_create_cart_for_session
+from utils import (
+    add_to_cart, get_cart, get_or_create_cart,
+)
 
 
 def add_item(request):
     """
     Adding item to cart by POST request.
-    Create new cart for session if necessary.
+    Create new cart for the visitor if necessary.
     """
     try:
-        cart = get_or_create_cart_for_session(request.session)
+        cart = get_or_create_cart(request)
         product_pk = request.POST.get('product_pk')
         product = Product.objects.get(pk=product_pk)
     except ObjectDoesNotExist:
         return HttpResponseRedirect('/')
 
-    if not CartItem.objects.filter(cart=cart, product=product):
-        cart_item = CartItem(
-            cart=cart,
-            product=product,
-            price=product.price,
-            )
-        cart_item.save()
+    add_to_cart(cart, product)
 
     return_path = request.POST.get('return_path', '/')
     return HttpResponseRedirect(return_path)
@@ -42,14 +38,14 @@ def remove_item(request):
     No affect cart without item
     """
     try:
-        cart = get_or_create_cart_for_session(request.session)
+        cart = get_cart(request)
         product_pk = request.POST.get('product_pk')
         product = Product.objects.get(pk=product_pk)
     except ObjectDoesNotExist:
         return HttpResponseRedirect('/')
 
-    if product_in_cart := CartItem.objects.filter(cart=cart, product=product):
-        product_in_cart.delete()
+    if cart.pk:
+        CartItem.objects.filter(cart=cart, product=product).delete()
 
     return_path = request.POST.get('return_path', '/')
     return HttpResponseRedirect(return_path)
@@ -0,0 +1,60 @@
+"""
+JSON API of cart for product cards: add, remove and list products
+without redirect and re-render of the page. Every answer is the new
+state of cart: {'product_ids': [...], 'count': n, 'subtotal': $}.
+Form endpoints (add_remove.py) are kept for browsers without JS.
+"""
+from django.http import JsonResponse
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET, require_POST
+
+from apps.cart.models import CartItem
+from apps.catalog.models import Product
+from utils import (
+    add_to_cart, get_cart, get_cart_state, get_or_create_cart,
+)
+
+
+def _get_product_pk(request):
+    """ pk of product from POST (None for a wrong one)"""
+    try:
+        return int(request.POST.get('product_pk', ''))
+    except ValueError:
+        return None
+
+
+def _product_not_found():
+    return JsonResponse({'error': 'Product not found'}, status=404)
+
+
+@never_cache
+@require_GET
+def cart_state(request):
+    """ Current state of the cart"""
+    return JsonResponse(get_cart_state(get_cart(request)))
+
+
+@require_POST
+def cart_add(request):
+    """ Put product to the cart (creates cart if needed)"""
+    product_pk = _get_product_pk(request)
+    product = (Product.objects.filter(pk=product_pk)
+               .only('base_price', 'discount').first()
+               if product_pk is not None else None)
+    if product is None:
+        return _product_not_found()
+    cart = get_or_create_cart(request)
+    add_to_cart(cart, product)
+    return JsonResponse(get_cart_state(cart))
+
+
+@require_POST
+def cart_remove(request):
+    """ Remove product from the cart (no error if it is not there)"""
+    product_pk = _get_product_pk(request)
+    if product_pk is None:
+        return _product_not_found()
+    cart = get_cart(request)
+    if cart.pk:
+        CartItem.objects.filter(cart=cart, product_id=product_pk).delete()
+    return JsonResponse(get_cart_state(cart))
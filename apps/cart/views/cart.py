@@ -5,7 +5,7 @@ from django.views.generic import TemplateView
 
 from apps.cart.models import CartItem
 from apps.cart.forms import OrderForm
-from utils import get_or_create_cart_for_session
+from utils import get_cart
 
 
 class CartView(TemplateView):
@@ -19,11 +19,13 @@ class CartView(TemplateView):
 
         context['form'] = OrderForm()
 
-        cart = get_or_create_cart_for_session(self.request.session)
-        cart_content = (
-            CartItem.objects.filter(cart=cart)
-            .select_related('product')
-        )
+        cart = get_cart(self.request)
+        cart_content = []
+        if cart.pk:
+            cart_content = list(
+                CartItem.objects.filter(cart=cart)
+                .select_related('product')
+            )
         context['cart'] = cart
         context['cart_content'] = cart_content
 
@@ -8,9 +8,9 @@ from django.core.mail import EmailMessage
 from django.shortcuts import HttpResponseRedirect
 from django.template.loader import render_to_string
 
-from apps.cart.models import CartItem, Order, OrderItem
+from apps.cart.models import OrderItem, OutgoingEmail
 from apps.cart.forms import OrderForm
-from utils import get_or_create_cart_for_session, set_reserve_for_order_items
+from utils import CheckoutConflict, checkout_cart, get_cart
 
 
 def send_confirm_to_user(order):
@@ -25,7 +25,8 @@ def send_confirm_to_user(order):
         'total_amount': total_amount,
     }
     email_html_content = render_to_string('email/order_created.html', context)
-    # Create and send the email message
+    # Create the email message and put it to the outbox
+    # (it's sent by 'send_queued_emails' worker)
     letter = EmailMessage(
         subject='Your Order Details',
         from_email=settings.DEFAULT_FROM_EMAIL,
@@ -33,7 +34,7 @@ def send_confirm_to_user(order):
         body=email_html_content,
     )
     letter.content_subtype = 'html'
-    letter.send()
+    OutgoingEmail.queue(letter)
 
 
 def send_confirm_to_admin(order):
@@ -48,7 +49,7 @@ def send_confirm_to_admin(order):
         # change to real email
         to=['admin_email@gmail.com'],
     )
-    letter.send()
+    OutgoingEmail.queue(letter)
 
 
 def make_order_from_cart(request):
@@ -57,7 +58,7 @@ def make_order_from_cart(request):
     if request.method != 'POST':
         return HttpResponseRedirect('main-page')
     try:
-        cart = get_or_create_cart_for_session(request.session)
+        cart = get_cart(request)
         form = OrderForm(request.POST)
         if not form.is_valid():
             messages.error(request, 'Error occurred, try again later.')
@@ -66,46 +67,33 @@ def make_order_from_cart(request):
         messages.error(request, 'Error occurred, try again later.')
         return HttpResponseRedirect('main-page')
 
-    # take only non-reserved and in-stock products from cart to order
-    items_in_cart = [
-        item for item in CartItem.objects.filter(cart=cart)
-        if item.product.in_stock and not item.product.reserved
-    ]
-    # create order for 'new' and non-empty cart only
-    if cart.status != 'NEW' or not items_in_cart:
-        messages.error(request, 'No items to be sold!')
-        return HttpResponseRedirect('main-page')
+    def send_confirmations(order):
+        send_confirm_to_user(order)
+        send_confirm_to_admin(order)
 
-    # create order
-    order = Order(
-        cart=cart,
-        customer_email=form.cleaned_data.get('customer_email').lower(),
-        country=form.cleaned_data.get('country').capitalize(),
-        message=form.cleaned_data.get('message'),
-        status='CREATED',
-    )
-    order.save()
-
-    # fill order with items from cart
-    for cart_item in items_in_cart:
-        order_item = OrderItem(
-            order=order,
-            product=cart_item.product,
-            price=cart_item.product.price,
+    # order, its items and confirmation e-mails are saved all together
+    # only non-reserved and in-stock products are taken to order
+    try:
+        order, lost_ids = checkout_cart(
+            cart,
+            on_created=send_confirmations,
+            customer_email=form.cleaned_data.get('customer_email').lower(),
+            country=form.cleaned_data.get('country').capitalize(),
+            message=form.cleaned_data.get('message'),
         )
-        order_item.save()
-
-    # reserve items in order not to sell them twice
-    set_reserve_for_order_items(order)
-
-    # change cart status
-    cart.status = 'ORDER'
-    cart.save()
+    except CheckoutConflict:
+        messages.error(request, 'Error occurred, try again later.')
+        return HttpResponseRedirect(request.POST.get('return_path', '/'))
 
-    send_confirm_to_user(order)
-    send_confirm_to_admin(order)
+    # create order for 'new' and non-empty cart only
+    if order is None:
+        messages.error(request, 'No items to be sold!')
+        return HttpResponseRedirect('main-page')
+    if lost_ids:
+        messages.warning(request, 'Some items were already sold or reserved'
+                                  ' and were not included in the order.')
 
-    messages.success(request, 'Order created. E-mail with details was sent.'
-                              ' Please, wait for invoice')
+    messages.success(request, 'Order created. E-mail with details will be'
+                              ' sent shortly. Please, wait for invoice')
     return_path = request.POST.get('return_path', '/')
     return HttpResponseRedirect(return_path)
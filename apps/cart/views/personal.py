@@ -0,0 +1,22 @@
+"""
+Personal fragment of public (cached) catalog pages: cart badge,
+card buttons and CSRF token for the forms (see page_cache.py).
+"""
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.urls import reverse
+from django.views.decorators.cache import never_cache
+
+from utils import get_cart_content
+
+
+@never_cache
+def personal_fragment(request):
+    """ Data of the visitor for a public page (JSON)"""
+    _, product_ids = get_cart_content(request)
+    return JsonResponse({
+        'cart_count': len(product_ids),
+        'cart_product_ids': sorted(product_ids),
+        'csrf_token': get_token(request),
+        'remove_url': reverse('remove-item'),
+    })
@@ -1,17 +1,28 @@
 """
 Admin pages for Product and Category
 """
+from decimal import Decimal
+
 from django import forms
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.contrib import admin
+from django.db.models import (
+    Case, DecimalField, F, IntegerField, Value, When,
+)
+from django.db.models.functions import Cast, Round
+from django.contrib import admin, messages
 from django.contrib.admin.helpers import ActionForm
-from django.template.loader import render_to_string
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, SEARCH_VAR
 from django.utils.safestring import mark_safe
+from django.utils.translation import get_language_bidi
 
 from mptt.admin import MPTTModelAdmin, TreeRelatedFieldListFilter
-from easy_thumbnails.templatetags.thumbnail import thumbnail_url
 
-from apps.catalog.models import Product, Category
+from apps.catalog.cache import invalidate_catalog
+from apps.catalog.category_tree import get_category_tree
+from apps.catalog.models import Product, Category, ThumbnailTask
+from apps.catalog.search import search_product_ids
 
 admin.site.site_title = "V.Olga Beads"
 admin.site.site_header = "V.Olga Beads"
@@ -21,6 +32,46 @@ class UpdateActionForm(ActionForm):
     """Add custom form fields for actions"""
     price = forms.IntegerField(required=False, label='New price')
     discount = forms.IntegerField(required=False, label='Discount')
+    multiplier = forms.DecimalField(
+        required=False, label='Multiply by', max_digits=4, decimal_places=2)
+
+    def clean(self):
+        # values are checked by the chosen action (with its own message),
+        # so a wrong value doesn't turn into 'No action selected'
+        for field in ('price', 'discount', 'multiplier'):
+            self._errors.pop(field, None)
+        return super().clean()
+
+
+class CategoryTreeListFilter(TreeRelatedFieldListFilter):
+    """ Filter by category with all its descendants,
+    choices and descendants are taken from cached category tree"""
+
+    def field_choices(self, field, request, model_admin):
+        indent = getattr(
+            model_admin, 'mptt_level_indent', self.mptt_level_indent)
+        side = 'right' if get_language_bidi() else 'left'
+        tree = get_category_tree()
+        levels = tree.levels()
+        return [
+            (pk, title,
+             mark_safe(f' style="padding-{side}:{indent * levels[pk]}px"'))
+            for pk, title in tree.choices()
+        ]
+
+    def queryset(self, request, queryset):
+        # wrong values of lookups: 'invalid lookup' message of the admin,
+        # as in TreeRelatedFieldListFilter (not an error 500)
+        try:
+            if self.lookup_val:
+                pk = int(self.lookup_val)
+                del self.used_parameters[self.changed_lookup_kwarg]
+                self.used_parameters[
+                    f'{self.field_path}__{self.rel_name}__in'] = (
+                    get_category_tree().descendants(pk))
+            return queryset.filter(**self.used_parameters)
+        except (ValidationError, ValueError) as error:
+            raise IncorrectLookupParameters(error)
 
 
 @admin.register(Product)
@@ -37,6 +88,9 @@ class ProductAdmin(admin.ModelAdmin):
 
     # add custom fields to action
     action_form = UpdateActionForm
+    # bulk changes of prices: one UPDATE for all selected products
+    actions = ['set_discount', 'clear_discount',
+               'set_base_price', 'multiply_base_price']
 
     # list appearance
     list_display = ('get_main_image', 'title', 'base_price', 'discount', 'price',
@@ -46,9 +100,11 @@ class ProductAdmin(admin.ModelAdmin):
     list_editable = ('base_price', 'discount', 'show_after_sale', 'promoted',
                      'in_stock', 'reserved')
     list_filter = ('show_after_sale', 'in_stock', 'reserved', 'discount',
-                   ('category', TreeRelatedFieldListFilter),
+                   ('category', CategoryTreeListFilter),
                    )
     search_fields = ('title',)
+    # the best matches of the search index shown in the list
+    search_results_limit = 1000
     ordering = ['show_after_sale', '-created_at', 'title']
 
     # instance appearance
@@ -120,38 +176,149 @@ class ProductAdmin(admin.ModelAdmin):
 
     def get_main_image(self, obj):
         """show image of Product at list page"""
-        return mark_safe(self._generate_html_for_image_field(obj.picture_1))
+        return mark_safe(self._generate_html_for_image_field(obj, 'picture_1'))
     get_main_image.short_description = "Main picture"
 
     def get_all_images(self, obj):
         """show images of Product at change page"""
-        html_for_images = (
-                self._generate_html_for_image_field(obj.picture_1) +
-                self._generate_html_for_image_field(obj.picture_2) +
-                self._generate_html_for_image_field(obj.picture_3) +
-                self._generate_html_for_image_field(obj.picture_4) +
-                self._generate_html_for_image_field(obj.picture_5)
+        html_for_images = ''.join(
+            self._generate_html_for_image_field(obj, field)
+            for field in Product.PICTURE_FIELDS
         )
         return mark_safe(html_for_images)
     get_all_images.short_description = "Pictures"
 
-    def _generate_html_for_image_field(self, img_field):
-        """html for thumbnail pictures of product with :hover resize"""
-        if not img_field:
+    def _generate_html_for_image_field(self, obj, field):
+        """html for thumbnail pictures of product with :hover resize
+        (urls from thumbnails manifest - no storage I/O)"""
+        if not getattr(obj, field):
             return ''
-        url_small = thumbnail_url(img_field, 'small')
-        url_medium = thumbnail_url(img_field, 'medium')
+        url_small = obj.get_thumbnail_url('small', field)
+        url_medium = obj.get_thumbnail_url('medium', field)
         return (f'<div class="admin-image-container">'
                 f'<img class="small-image" src={url_small} alt="small-img">'
                 f'<img class="medium-image" src={url_medium} alt="medium-img">'
                 '</div>'
                 )
 
+    def _get_action_value(self, request, field, min_value, max_value):
+        """ Value of the action form field checked to be in range
+        (None and error message for wrong value)"""
+        form_field = self.action_form.base_fields[field]
+        try:
+            value = form_field.clean(request.POST.get(field))
+        except ValidationError:
+            value = None
+        if value is None or not min_value <= value <= max_value:
+            self.message_user(
+                request,
+                f'{form_field.label}: enter a number'
+                f' from {min_value} to {max_value}.',
+                level=messages.ERROR,
+            )
+            return None
+        return value
+
+    def _update_products(self, request, queryset, message, **fields):
+        """ Single UPDATE for all selected products (with 'select all' -
+        for all pages of the filtered list), no Product.save() calls"""
+        updated = queryset.update(**fields)
+        # .update() sends no signals: drop cached catalog data explicitly
+        invalidate_catalog()
+        self.message_user(request, f'{message} for {updated} products.')
+
+    def set_discount(self, request, queryset):
+        """ Set discount % from action form for selected products"""
+        discount = self._get_action_value(request, 'discount', 0, 99)
+        if discount is not None:
+            self._update_products(
+                request, queryset, f'Discount {discount}% set',
+                discount=discount)
+    set_discount.short_description = 'Set discount %% (Discount field)'
+
+    def clear_discount(self, request, queryset):
+        """ Remove discount of selected products"""
+        self._update_products(
+            request, queryset, 'Discount removed', discount=0)
+    clear_discount.short_description = 'Clear discount'
+
+    def set_base_price(self, request, queryset):
+        """ Set base price from action form for selected products"""
+        price = self._get_action_value(request, 'price', 0, 1000000)
+        if price is not None:
+            self._update_products(
+                request, queryset, f'Base price {price} set',
+                base_price=price)
+    set_base_price.short_description = 'Set base price (New price field)'
+
+    def multiply_base_price(self, request, queryset):
+        """ Multiply base price of selected products (rounded to integer)"""
+        multiplier = self._get_action_value(
+            request, 'multiplier', Decimal('0.01'), Decimal('10'))
+        if multiplier is not None:
+            self._update_products(
+                request, queryset, f'Base price multiplied by {multiplier}',
+                base_price=Cast(
+                    Round(F('base_price') * Value(
+                        multiplier, output_field=DecimalField())),
+                    output_field=IntegerField(),
+                ),
+            )
+    multiply_base_price.short_description = (
+        'Multiply base price (Multiply by field)')
+
+    def formfield_for_manytomany(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_manytomany(
+            db_field, request, **kwargs)
+        if db_field.name == 'category':
+            # choices from cached category tree: no query for the widget
+            formfield.choices = get_category_tree().choices()
+        return formfield
+
+    def _search_product_ids(self, request, search_term):
+        """ Products found by the index, the best matches first
+        (searched once per request: results and their ordering)"""
+        found = getattr(request, 'found_products', None)
+        if found is None or found[0] != search_term:
+            found = request.found_products = (
+                search_term,
+                search_product_ids(search_term, self.search_results_limit))
+        return found[1]
+
+    def get_search_results(self, request, queryset, search_term):
+        """search by the full-text index (title, description, categories,
+        sizes) instead of icontains scan of titles"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        product_ids = self._search_product_ids(request, search_term)
+        if len(product_ids) >= self.search_results_limit:
+            self.message_user(
+                request,
+                f'Only {self.search_results_limit} best matches are shown, '
+                f'refine the search.',
+                level=messages.WARNING,
+            )
+        return queryset.filter(pk__in=product_ids), False
+
+    def get_ordering(self, request):
+        """ Search results: the best matches first (rank of the index),
+        unless the list is sorted by a column"""
+        search_term = request.GET.get(SEARCH_VAR, '').strip()
+        if search_term and ORDER_VAR not in request.GET:
+            product_ids = self._search_product_ids(request, search_term)
+            if product_ids:
+                return [Case(
+                    *(When(pk=pk, then=Value(position))
+                      for position, pk in enumerate(product_ids)),
+                    output_field=IntegerField(),
+                )]
+        return super().get_ordering(request)
+
     def draw_category_tree(self, obj):
-        """show category tree at change page for convenience (mptt based)"""
-        nodes = Category.objects.all()
-        return render_to_string(
-            "for_admin/construct_category_tree.html", {'nodes': nodes})
+        """show category tree at change page for convenience
+        (pre-rendered, cached until categories are changed)"""
+        return mark_safe(get_category_tree().html)
 
 
 @admin.register(Category)
@@ -166,3 +333,14 @@ class CategoryAdmin(MPTTModelAdmin):
 
     class Meta:
         verbose_name_plural = 'Categories'
+
+
+@admin.register(ThumbnailTask)
+class ThumbnailTaskAdmin(admin.ModelAdmin):
+    """ Pictures waiting for thumbnails: view generation status and errors"""
+    list_display = ('id', 'product', 'field', 'status', 'attempts',
+                    'created', 'next_attempt')
+    list_filter = ('status',)
+    list_select_related = ('product',)
+    readonly_fields = ('product', 'field', 'created', 'attempts',
+                       'last_error')
@@ -1,7 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CatalogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.catalog'
     verbose_name = 'Catalog'
+
+    def ready(self):
+        # connect signal handlers for cache invalidation
+        from apps.catalog import signals  # noqa: F401
+        # native full-text index (PostgreSQL) is created after migrate
+        from apps.catalog.search import create_native_index
+        post_migrate.connect(create_native_index, sender=self)
@@ -0,0 +1,103 @@
+"""
+Versioned cache for snapshots of catalog data (navigation, promotions...).
+Every snapshot is kept in a process-local cache backed by Django's cache
+framework. Any change of catalog bumps the shared catalog version
+(see signals.py), so all processes rebuild their snapshots.
+Snapshots of categories only (admin category tree) use their own version,
+bumped by changes of categories.
+The version starts with the time of the change (Last-Modified of pages).
+The version is shared only by a shared cache backend (see CACHES setting):
+with a process-local one (LocMemCache) it expires after
+LOCAL_VERSION_TIMEOUT seconds, so other processes rebuild in time.
+A cache keeping nothing (DummyCache) is the same, but the version
+is held by the process itself.
+"""
+import time
+import uuid
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATEGORIES_VERSION_KEY = 'catalog:categories:version'
+SNAPSHOT_KEY = 'catalog:{name}:{version}'
+SNAPSHOT_TIMEOUT = 86400
+LOCAL_VERSION_TIMEOUT = 60
+
+# process-local copies of snapshots: {name: (version, snapshot)}
+_local_cache = {}
+# versions of this process for a cache keeping nothing (DummyCache)
+_local_versions = {}
+_MISSING = object()
+
+
+def _version_timeout():
+    """ Version is kept forever only in a cache shared by all processes"""
+    if isinstance(caches['default'], (LocMemCache, DummyCache)):
+        return LOCAL_VERSION_TIMEOUT
+    return None
+
+
+def _new_version():
+    """ '<unix time>.<random>': unique, with the time of the change"""
+    return f'{int(time.time())}.{uuid.uuid4().hex}'
+
+
+def get_catalog_version(version_key=CATALOG_VERSION_KEY):
+    """ Current version of catalog data (the same for all processes)"""
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, _new_version(), _version_timeout())
+        version = cache.get(version_key)
+    if version is None:
+        # the cache keeps nothing (DummyCache): the version of this
+        # process, renewed as the one of a process-local cache
+        version = _local_versions.get(version_key)
+        if (version is None or time.time() - int(version.split('.')[0])
+                > LOCAL_VERSION_TIMEOUT):
+            version = _local_versions[version_key] = _new_version()
+    return version
+
+
+def get_catalog_modified(version_key=CATALOG_VERSION_KEY):
+    """ Unix time of the last change of catalog data (not earlier
+    than the real one: the time of the version creation)"""
+    return int(get_catalog_version(version_key).split('.')[0])
+
+
+def get_snapshot(name, build, version_key=CATALOG_VERSION_KEY):
+    """ Get snapshot: process-local copy if it is still actual,
+    then shared cache, and build() it from DB as the last resort"""
+    version = get_catalog_version(version_key)
+    local_version, snapshot = _local_cache.get(name, (_MISSING, None))
+    if local_version == version:
+        return snapshot
+
+    key = SNAPSHOT_KEY.format(name=name, version=version)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build()
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    _local_cache[name] = (version, snapshot)
+    return snapshot
+
+
+def invalidate_catalog(categories=False):
+    """ Drop snapshots in this process and (after commit)
+    force all processes to rebuild them.
+    categories=True - categories were changed: rebuild snapshots
+    of categories only too"""
+    _local_cache.clear()
+    version_keys = [CATALOG_VERSION_KEY]
+    if categories:
+        version_keys.append(CATEGORIES_VERSION_KEY)
+
+    def bump_versions():
+        for key in version_keys:
+            _local_versions.pop(key, None)
+        cache.set_many({key: _new_version() for key in version_keys},
+                       _version_timeout())
+
+    transaction.on_commit(bump_versions)
@@ -0,0 +1,54 @@
+"""
+Cached snapshot of the whole category tree for admin pages of products:
+pre-rendered tree for the change page, choices for the categories widget
+and for the list filter. The tree is built with one query and kept
+in the versioned cache of categories (see cache.py).
+"""
+from django.template.loader import render_to_string
+
+from apps.catalog.cache import CATEGORIES_VERSION_KEY, get_snapshot
+from apps.catalog.models import Category
+
+
+class CategoryTree:
+    """ Snapshot of categories in tree order (tree_id, lft)"""
+
+    def __init__(self, nodes):
+        # plain tuples (pk, title, level, tree_id, lft, rght): cheap to pickle
+        self.rows = [
+            (node.pk, node.title, node.level, node.tree_id,
+             node.lft, node.rght)
+            for node in nodes
+        ]
+        self.html = render_to_string(
+            'for_admin/construct_category_tree.html', {'nodes': nodes})
+
+    def choices(self):
+        """ (pk, title) for select widgets"""
+        return [(pk, title) for pk, title, *_ in self.rows]
+
+    def levels(self):
+        """ {pk: level} for indents in the list filter"""
+        return {pk: level for pk, _, level, *_ in self.rows}
+
+    def descendants(self, pk):
+        """ pk-s of the category and all its descendants (MPTT range)"""
+        for node_pk, _, _, tree_id, lft, rght in self.rows:
+            if node_pk == pk:
+                return [
+                    row[0] for row in self.rows
+                    if row[3] == tree_id and lft <= row[4] <= rght
+                ]
+        return []
+
+
+def build_category_tree():
+    """ Build category tree snapshot from DB (1 query)"""
+    return CategoryTree(list(Category.objects.all()))
+
+
+def get_category_tree():
+    """ Get category tree snapshot (no queries while categories
+    are not changed)"""
+    return get_snapshot(
+        'category_tree', build_category_tree, CATEGORIES_VERSION_KEY)
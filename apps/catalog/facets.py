@@ -0,0 +1,212 @@
+"""
+Faceted filtering of product listings by hole position, mandrel, size
+and price with numbers of products for every facet value.
+Numbers are counted from the facet summary of a listing: products number
+for every combination of facet values, built with one grouped query
+and kept in the versioned catalog cache (see cache.py). So any selection
+of facet values is counted without queries.
+Selections are normalized (known values only, fixed order), the same
+selection always has the same query string - the key of its counts
+cached in the summary.
+"""
+from urllib.parse import urlencode
+
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+from apps.catalog.cache import get_snapshot
+from apps.catalog.models import Product
+
+# [low, high) ranges of price in U$D, None - no upper limit
+PRICE_BUCKETS = ((0, 10), (10, 20), (20, 50), (50, 100), (100, None))
+# counts of this many selections are kept by every summary
+SELECTIONS_CACHE_SIZE = 256
+
+
+def _price_label(bucket):
+    low, high = PRICE_BUCKETS[bucket]
+    if not low:
+        return f'under ${high}'
+    if high is None:
+        return f'${low} and more'
+    return f'${low} - ${high}'
+
+
+class Facet:
+    """ Filter of products by values of one field"""
+
+    def __init__(self, param, title, field, convert, labels):
+        # name of GET parameter
+        self.param = param
+        self.title = title
+        # field (or annotation) of product in summary and filter
+        self.field = field
+        # value from GET parameter (ValueError/TypeError for wrong one)
+        self.convert = convert
+        # value -> label (None - value is unknown)
+        self.labels = labels
+
+    def parse(self, raw_values):
+        """ Known values of the facet from GET parameter values"""
+        values = set()
+        for raw in raw_values:
+            try:
+                value = self.convert(raw)
+            except (TypeError, ValueError):
+                continue
+            if self.labels(value) is not None:
+                values.add(value)
+        return frozenset(values)
+
+    def filter(self, values):
+        return Q(**{f'{self.field}__in': values})
+
+
+class PriceFacet(Facet):
+    """ Filter by price buckets: ranges of the current price"""
+
+    def filter(self, values):
+        condition = Q()
+        for bucket in values:
+            low, high = PRICE_BUCKETS[bucket]
+            bucket_condition = Q(current_price__gte=low)
+            if high is not None:
+                bucket_condition &= Q(current_price__lt=high)
+            condition |= bucket_condition
+        return condition
+
+
+FACETS = (
+    Facet('hole', 'Hole', 'hole_position', str,
+          dict(Product.HOLES_CHOICES).get),
+    Facet('mandrel', 'Mandrel', 'hole_size', int,
+          dict(Product.MANDRELS_CHOICES).get),
+    Facet('size', 'Size', 'size_1', int,
+          lambda size: f'{size} mm' if size > 0 else None),
+    PriceFacet('price', 'Price', 'price_bucket', int,
+               lambda bucket: (_price_label(bucket)
+                               if 0 <= bucket < len(PRICE_BUCKETS) else None)),
+)
+
+
+def parse_selection(query_dict):
+    """ Normalized selection {param: frozenset of values} from GET"""
+    selection = {}
+    for facet in FACETS:
+        values = facet.parse(query_dict.getlist(facet.param))
+        if values:
+            selection[facet.param] = values
+    return selection
+
+
+def selection_query(selection):
+    """ Query string of selection (the same for equal selections)"""
+    return urlencode([
+        (facet.param, value)
+        for facet in FACETS
+        for value in sorted(selection.get(facet.param, ()))
+    ])
+
+
+def _with_price_bucket(queryset):
+    if 'current_price' not in queryset.query.annotations:
+        queryset = queryset.with_price()
+    return queryset.annotate(price_bucket=Case(
+        *[When(current_price__lt=high, then=Value(bucket))
+          for bucket, (_, high) in enumerate(PRICE_BUCKETS)
+          if high is not None],
+        default=Value(len(PRICE_BUCKETS) - 1),
+        output_field=IntegerField(),
+    ))
+
+
+def filter_products(queryset, selection):
+    """ Products of queryset having the selected facet values
+    (any of values of a facet, all facets)"""
+    if not selection:
+        return queryset
+    if 'price' in selection and 'current_price' not in (
+            queryset.query.annotations):
+        queryset = queryset.with_price()
+    for facet in FACETS:
+        if facet.param in selection:
+            queryset = queryset.filter(facet.filter(selection[facet.param]))
+    return queryset
+
+
+class FacetSummary:
+    """ Numbers of products of a listing for combinations of facet values"""
+
+    def __init__(self, rows):
+        # (value of every facet in FACETS order..., products number)
+        self.rows = rows
+        # selection query -> counted facets
+        self._selections = {}
+
+    def __getstate__(self):
+        # counted selections are not shared by cache
+        return {'rows': self.rows, '_selections': {}}
+
+    def _matches(self, row, selection, skipped=None):
+        return all(
+            row[position] in selection[facet.param]
+            for position, facet in enumerate(FACETS)
+            if facet.param in selection and facet.param != skipped
+        )
+
+    def total(self, selection):
+        """ Number of products with the selected values"""
+        return sum(row[-1] for row in self.rows
+                   if self._matches(row, selection))
+
+    def facets(self, selection):
+        """ Facets with options (value, label, count, selected, query
+        of the selection with the value toggled). Count of a value:
+        products matching selection of other facets and the value"""
+        query = selection_query(selection)
+        if query in self._selections:
+            return self._selections[query]
+        facets = []
+        for position, facet in enumerate(FACETS):
+            counts = {}
+            for row in self.rows:
+                if self._matches(row, selection, skipped=facet.param):
+                    value = row[position]
+                    counts[value] = counts.get(value, 0) + row[-1]
+            selected = selection.get(facet.param, frozenset())
+            options = []
+            for value in sorted(set(counts) | selected):
+                label = facet.labels(value)
+                if label is None:
+                    continue
+                toggled = dict(selection)
+                toggled[facet.param] = selected ^ {value}
+                options.append({
+                    'value': value,
+                    'label': label,
+                    'count': counts.get(value, 0),
+                    'selected': value in selected,
+                    'query': selection_query(toggled),
+                })
+            # a single value doesn't filter anything
+            if len(options) > 1 or selected:
+                facets.append({'param': facet.param, 'title': facet.title,
+                               'options': options})
+        if len(self._selections) >= SELECTIONS_CACHE_SIZE:
+            self._selections.clear()
+        self._selections[query] = facets
+        return facets
+
+
+def build_facet_summary(queryset):
+    """ Facet summary of the listing queryset (1 grouped query)"""
+    rows = (_with_price_bucket(queryset).order_by()
+            .values_list(*[facet.field for facet in FACETS])
+            .annotate(number=Count('pk')))
+    return FacetSummary([tuple(row) for row in rows])
+
+
+def get_facet_summary(listing, queryset):
+    """ Facet summary of the listing ('main' or category slug)
+    from the versioned catalog cache"""
+    return get_snapshot(
+        f'facets:{listing}', lambda: build_facet_summary(queryset))
@@ -0,0 +1,110 @@
+"""
+Image pipeline of product pictures.
+Uploaded originals are normalized before they are stored: rotated by
+EXIF orientation, converted to RGB, downscaled to ORIGINAL_MAX_SIZE
+and saved as JPEG without metadata (EXIF of phone photos has GPS).
+The thumbnails worker (see thumbnails.py) renders responsive renditions
+of every picture (WebP and AVIF, if Pillow can write it, of several
+widths for srcset) and a placeholder painted before the image is loaded:
+the dominant colour and a tiny preview as a data URI.
+"""
+import base64
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+try:
+    # AVIF for Pillow < 11 (optional)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# normalized original: 2x of the biggest displayed size
+ORIGINAL_MAX_SIZE = 1500
+ORIGINAL_QUALITY = 90
+# renditions: mime type -> (Pillow format, file extension, save options)
+RENDITION_FORMATS = {
+    'image/avif': ('AVIF', 'avif', {'quality': 55}),
+    'image/webp': ('WEBP', 'webp', {'quality': 80, 'method': 6}),
+}
+# width of the tiny preview of placeholder (px)
+PLACEHOLDER_WIDTH = 12
+
+
+def rendition_widths():
+    """ Widths of renditions for srcset (px)"""
+    return tuple(getattr(settings, 'PICTURE_WIDTHS', (280, 560, 750)))
+
+
+def rendition_formats():
+    """ Mime types of renditions Pillow can write, the best first"""
+    Image.init()
+    return [mime for mime, (image_format, _, _) in RENDITION_FORMATS.items()
+            if image_format in Image.SAVE]
+
+
+def open_picture(data):
+    """ Upright RGB image from picture file content"""
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # transparent background of a cut out bead: white, as on the page
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def normalize_picture(upload):
+    """ Normalized JPEG (name, ContentFile) of uploaded picture"""
+    upload.seek(0)
+    image = open_picture(upload.read())
+    image.thumbnail((ORIGINAL_MAX_SIZE, ORIGINAL_MAX_SIZE),
+                    Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    # no exif/icc: metadata is dropped
+    image.save(buffer, 'JPEG', quality=ORIGINAL_QUALITY, optimize=True,
+               progressive=True)
+    name = os.path.splitext(os.path.basename(upload.name))[0] + '.jpg'
+    return name, ContentFile(buffer.getvalue())
+
+
+def render_renditions(image, name):
+    """ [((mime type, width), file name, content)] of the picture
+    for every rendition format and width not bigger than the picture"""
+    widths = sorted({min(width, image.width)
+                     for width in rendition_widths()})
+    renditions = []
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = (image if width == image.width else image.resize(
+            (width, height), Image.Resampling.LANCZOS))
+        for mime in rendition_formats():
+            image_format, extension, options = RENDITION_FORMATS[mime]
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            renditions.append(((mime, width), f'{name}.{width}w.{extension}',
+                               buffer.getvalue()))
+    return renditions
+
+
+def describe_picture(image):
+    """ Size and placeholder of the picture for the manifest"""
+    color = image.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    preview = image.resize(
+        (PLACEHOLDER_WIDTH,
+         max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))),
+        Image.Resampling.BOX)
+    buffer = io.BytesIO()
+    preview.save(buffer, 'WEBP', quality=30)
+    return {
+        'width': image.width,
+        'height': image.height,
+        'color': '#{:02x}{:02x}{:02x}'.format(*color),
+        'placeholder': 'data:image/webp;base64,'
+                       + base64.b64encode(buffer.getvalue()).decode(),
+    }
@@ -0,0 +1,151 @@
+"""
+Generate missing and stale thumbnails of product pictures in parallel
+(see apps/catalog/thumbnails.py) and put their urls to manifests.
+Without --queued all products are walked in pk order: pictures with
+up to date manifest entries are skipped, so an interrupted run is just
+started again (or continued with --start-after the last reported pk).
+With --queued it is the worker of pictures queued by Product.save:
+run periodically (cron) or permanently with --loop.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.catalog.models import Product, ThumbnailTask
+from apps.catalog.thumbnails import (
+    ThumbnailGenerator, manifest_signature, save_manifests, stale_pictures,
+)
+
+# seconds: delay after the 1st failure, doubled for every next one
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 5
+# seconds: claimed tasks are not taken by other workers meanwhile
+# (and are taken again if this worker dies)
+CLAIM_TIMEOUT = 600
+
+
+def claim_tasks(batch_size):
+    """ Take due pending tasks for this worker (short transaction)"""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            ThumbnailTask.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt__lte=now)
+            .order_by('next_attempt')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        ThumbnailTask.objects.filter(pk__in=ids).update(
+            attempts=F('attempts') + 1,
+            next_attempt=now + timedelta(seconds=CLAIM_TIMEOUT),
+        )
+    return list(ThumbnailTask.objects.filter(pk__in=ids)
+                .select_related('product'))
+
+
+def mark_failed(task, error):
+    """ Schedule the next attempt or give up"""
+    delay = min(RETRY_DELAY * 2 ** (task.attempts - 1), MAX_RETRY_DELAY)
+    # queued again meanwhile (attempts are reset): not touched
+    ThumbnailTask.objects.filter(pk=task.pk, attempts=task.attempts).update(
+        last_error=str(error) or repr(error),
+        next_attempt=timezone.now() + timedelta(seconds=delay),
+        status='FAILED' if task.attempts >= MAX_ATTEMPTS else 'PENDING',
+    )
+
+
+class Command(BaseCommand):
+    help = ('Generate missing and stale thumbnails and renditions '
+            'of product pictures')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Generate thumbnails of all pictures, not only stale ones')
+        parser.add_argument(
+            '--start-after', type=int, default=0, metavar='PK',
+            help='Skip products with pk up to this one')
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='Rendering processes (default: number of CPUs)')
+        parser.add_argument(
+            '--uploads', type=int, default=4,
+            help='Concurrent uploads to the thumbnail storage')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--queued', action='store_true',
+            help='Generate only pictures queued by changes of products')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='With --queued: keep running and check the queue '
+                 'every --interval seconds')
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, **options):
+        signature = manifest_signature()
+        with ThumbnailGenerator(options['processes'],
+                                options['uploads']) as generator:
+            if options['queued']:
+                self.generate_queued(generator, signature, options)
+            else:
+                self.generate_all(generator, signature, options)
+            self.stdout.write(generator.report())
+
+    def generate_all(self, generator, signature, options):
+        products = (
+            Product.objects.filter(pk__gt=options['start_after'])
+            .order_by('pk').only('thumbnails', *Product.PICTURE_FIELDS)
+        )
+        batch = []
+        last_pk = None
+        for product in products.iterator(chunk_size=options['batch_size']):
+            last_pk = product.pk
+            batch += [(product.pk, field, name) for field, name
+                      in stale_pictures(product, signature, options['force'])]
+            if len(batch) >= options['batch_size']:
+                self.generate_batch(generator, signature, batch, last_pk)
+                batch = []
+        if batch:
+            self.generate_batch(generator, signature, batch, last_pk)
+
+    def generate_batch(self, generator, signature, jobs, last_pk):
+        results = generator.generate(jobs)
+        save_manifests(results, signature)
+        for (pk, field, name), result in results.items():
+            if isinstance(result, Exception):
+                self.stderr.write(f'{pk} {field} ({name}): {result!r}')
+        # checkpoint for --start-after
+        self.stdout.write(f'Done up to pk {last_pk}. {generator.report()}')
+
+    def generate_queued(self, generator, signature, options):
+        while True:
+            tasks = claim_tasks(options['batch_size'])
+            jobs = {}
+            for task in tasks:
+                picture = getattr(task.product, task.field, None)
+                if picture:
+                    jobs[(task.product_id, task.field, picture.name)] = task
+            results = generator.generate(jobs)
+            save_manifests(results, signature)
+            done = [task.pk for task in tasks]
+            for job, result in results.items():
+                if isinstance(result, Exception):
+                    mark_failed(jobs[job], result)
+                    done.remove(jobs[job].pk)
+            # picture changed again meanwhile: the task is kept
+            # (queued again: no attempts)
+            ThumbnailTask.objects.filter(
+                pk__in=done, attempts__gt=0).delete()
+            if tasks:
+                self.stdout.write(
+                    f'Tasks: {len(tasks)}. {generator.report()}')
+            # full batch: there may be more due tasks right now
+            if len(tasks) >= options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+"""
+Rebuild search documents of all products
+(needed once for existing DB, documents are kept in sync by signals)
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from apps.catalog.models import Product, ProductSearchDocument
+from apps.catalog.search import index_products, remove_products
+
+
+class Command(BaseCommand):
+    help = 'Rebuild search documents of all products'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+        index_products(product_ids)
+        # documents of products deleted without signals (e.g. by raw SQL)
+        stale_ids = list(ProductSearchDocument.objects.filter(
+            ~Exists(Product.objects.filter(pk=OuterRef('product_id'))),
+            is_deleted=False,
+        ).values_list('product_id', flat=True))
+        remove_products(stale_ids)
+        self.stdout.write(
+            f'Done. Indexed: {len(product_ids)}, removed: {len(stale_ids)} '
+            f'in {time.perf_counter() - started:.1f}s')
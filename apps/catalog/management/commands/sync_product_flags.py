@@ -0,0 +1,18 @@
+"""
+Recalculate denormalized flags of all products
+(needed once after adding the flags to existing DB)
+"""
+from django.core.management.base import BaseCommand
+
+from apps.catalog.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Recalculate denormalized Product flags (is_tutorial, is_visible)'
+
+    def handle(self, *args, **options):
+        Product.objects.all().sync_tutorial_flags()
+        Product.objects.all().sync_visibility_flags()
+        tutorials = Product.objects.filter(is_tutorial=True).count()
+        visible = Product.objects.filter(is_visible=True).count()
+        self.stdout.write(f'Done. Tutorials: {tutorials}, visible: {visible}')
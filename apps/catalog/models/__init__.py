@@ -3,8 +3,12 @@ Base models Product and Category for the catalog of the web shop
 """
 from .category import Category
 from .product import Product
+from .search import ProductSearchDocument
+from .thumbnails import ThumbnailTask
 
 __all__ = (
     'Category',
     'Product',
+    'ProductSearchDocument',
+    'ThumbnailTask',
 )
@@ -2,9 +2,112 @@
 Base Product model for catalog of web shop
 """
 from django.db import models
+from django.db.models import (
+    Case, Exists, ExpressionWrapper, F, OuterRef, Q, Value, When,
+)
+from django.db.models.lookups import Exact
 from django.urls import reverse
+from django.utils import timezone
 
-from apps.catalog.models import Category
+from easy_thumbnails.templatetags.thumbnail import thumbnail_url
+
+from apps.catalog.images import normalize_picture
+
+from .thumbnails import ThumbnailTask
+
+
+class ProductQuerySet(models.QuerySet):
+    """Bulk operations keeping denormalized flags of products consistent:
+    'tutorials are never reserved' and 'is_visible' rules"""
+
+    def update(self, **kwargs):
+        if 'reserved' in kwargs:
+            kwargs['reserved'] = Case(
+                When(is_tutorial=True, then=Value(False)),
+                default=kwargs['reserved'],
+            )
+        if 'in_stock' in kwargs or 'show_after_sale' in kwargs:
+            kwargs['is_visible'] = self._visibility_after_update(kwargs)
+        # auto_now is not applied by .update(): version stamp for caches
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+    @staticmethod
+    def _visibility_after_update(kwargs):
+        """ is_visible for update of in_stock/show_after_sale: constant
+        for plain values, computed in SQL for expressions (F, Case...)"""
+        visible_by = Q()
+        for field in ('in_stock', 'show_after_sale'):
+            # not updated field keeps its current value in DB
+            value = kwargs.get(field, F(field))
+            if not hasattr(value, 'resolve_expression'):
+                if value:
+                    return True
+                continue
+            # SET uses values of the row before the update: the new
+            # value is the expression itself, not the column
+            visible_by |= Q(Exact(value, True))
+        if not visible_by:
+            return False
+        return ExpressionWrapper(visible_by,
+                                 output_field=models.BooleanField())
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        # objs may be a generator: it is iterated twice
+        objs = list(objs)
+        fields = list(fields)
+        now = timezone.now()
+        for obj in objs:
+            obj.sync_flags()
+            obj.updated_at = now
+        if 'in_stock' in fields or 'show_after_sale' in fields:
+            fields.append('is_visible')
+        fields.append('updated_at')
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.sync_flags()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def with_price(self):
+        """ Annotate current_price (same as Product.price) to filter
+        and sort by real price in SQL"""
+        return self.annotate(current_price=ExpressionWrapper(
+            F('base_price') * (100 - F('discount')) / 100,
+            output_field=models.IntegerField(),
+        ))
+
+    def in_category(self, category):
+        """ Products of the category and all its descendants:
+        EXISTS on MPTT range of the category (no duplicates of join,
+        no DISTINCT), plain category filter for a leaf"""
+        links = Product.category.through.objects.filter(product=OuterRef('pk'))
+        if category.is_leaf_node():
+            links = links.filter(category_id=category.pk)
+        else:
+            links = links.filter(
+                category__tree_id=category.tree_id,
+                category__lft__gte=category.lft,
+                category__lft__lte=category.rght,
+            )
+        return self.filter(Exists(links))
+
+    def sync_visibility_flags(self):
+        """ Recalculate denormalized is_visible from stock fields"""
+        self.update(is_visible=ExpressionWrapper(
+            Q(in_stock=True) | Q(show_after_sale=True),
+            output_field=models.BooleanField(),
+        ))
+
+    def sync_tutorial_flags(self):
+        """ Recalculate denormalized is_tutorial from categories"""
+        in_tutorials = Product.category.through.objects.filter(
+            product=OuterRef('pk'), category__slug='tutorials')
+        self.update(is_tutorial=Exists(in_tutorials))
+        # second statement: flag must be already updated here
+        self.filter(is_tutorial=True).update(reserved=False)
 
 
 class Product(models.Model):
@@ -13,6 +116,8 @@ class Product(models.Model):
     slug = models.SlugField(max_length=150, blank=False, unique=True)
     created_at = models.DateTimeField(
         auto_now_add=True, verbose_name='Created', blank=False)
+    # version stamp of product for cached fragments (cards)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated')
     category = models.ManyToManyField(
         'Category', related_name='products', blank=False)
 
@@ -29,6 +134,13 @@ class Product(models.Model):
     in_stock = models.BooleanField(default=True, blank=False)
     reserved = models.BooleanField(default=False, blank=False)
 
+    # denormalized 'in_stock or show_after_sale' flag for storefront listing
+    is_visible = models.BooleanField(default=True, editable=False)
+
+    # denormalized 'product is in tutorials category' flag,
+    # kept in sync by m2m_changed signal (see signals.py)
+    is_tutorial = models.BooleanField(default=False, editable=False)
+
     # special status for filling 'promotion' section of website
     promoted = models.BooleanField(default=False, blank=False)
 
@@ -45,6 +157,12 @@ class Product(models.Model):
     picture_3 = models.ImageField(upload_to='photos/', null=True, blank=True)
     picture_4 = models.ImageField(upload_to='photos/', null=True, blank=True)
     picture_5 = models.ImageField(upload_to='photos/', null=True, blank=True)
+    PICTURE_FIELDS = (
+        'picture_1', 'picture_2', 'picture_3', 'picture_4', 'picture_5')
+
+    # manifest of thumbnails: {picture field: {'name': picture name,
+    # alias: url}}, read instead of checking thumbnails in storage
+    thumbnails = models.JSONField(default=dict, blank=True, editable=False)
 
     # video if exists
     link_to_video = models.URLField(null=True, blank=True)
@@ -75,8 +193,9 @@ class Product(models.Model):
 
     @property
     def price(self):
-        """ count current price with discount. No double information in DB"""
-        return int(self.base_price * (1 - self.discount / 100))
+        """ count current price with discount. No double information in DB.
+        Integer arithmetic - the same as ProductQuerySet.with_price() in SQL"""
+        return self.base_price * (100 - self.discount) // 100
     price.fget.short_description = 'Price-disc'
 
     @property
@@ -94,21 +213,79 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('product', args=[str(self.slug)])
 
-    def save(self, *args, **kwargs):
+    objects = ProductQuerySet.as_manager()
+
+    def sync_flags(self):
+        """ Keep denormalized flags consistent with other fields"""
         # make tutorials always available - no 'reserved'
+        if self.is_tutorial:
+            self.reserved = False
+        self.is_visible = self.in_stock or self.show_after_sale
 
-        # save first to be sure to have id for further actions (it's about new)
-        super().save(*args, **kwargs)
+    def get_thumbnail_url(self, alias, field='picture_1'):
+        """ url of thumbnail from manifest (no storage I/O): the picture
+        itself while its thumbnails are queued, generated by easy_thumbnails
+        if missing in manifest"""
+        picture = getattr(self, field)
+        if not picture:
+            return ''
+        entry = self.thumbnails.get(field, {})
+        if entry.get('name') == picture.name:
+            return entry.get(alias) or picture.url
+        return thumbnail_url(picture, alias)
 
-        # then check categories
-        tutorials_category = Category.objects.get(slug='tutorials')
-        if tutorials_category in self.category.all():
-            # self.in_stock = True
-            self.reserved = False
+    def queue_thumbnails(self):
+        """ Mark changed pictures in manifest as waiting for thumbnails
+        and queue them for the worker. Returns True if manifest was changed."""
+        manifest = dict(self.thumbnails)
+        changed = False
+        queued = []
+        for field in self.PICTURE_FIELDS:
+            picture = getattr(self, field)
+            if not picture:
+                changed |= manifest.pop(field, None) is not None
+            elif manifest.get(field, {}).get('name') != picture.name:
+                manifest[field] = {'name': picture.name}
+                queued.append(field)
+        if queued:
+            ThumbnailTask.queue(self.pk, queued)
+        self.thumbnails = manifest
+        return changed or bool(queued)
+
+    def normalize_pictures(self):
+        """ Store new uploaded pictures normalized (see images.py)"""
+        for field in self.PICTURE_FIELDS:
+            picture = getattr(self, field)
+            if picture and not picture._committed:
+                name, content = normalize_picture(picture.file)
+                picture.save(name, content, save=False)
+
+    def save(self, *args, **kwargs):
+        self.sync_flags()
+        self.normalize_pictures()
         super().save(*args, **kwargs)
+        # pictures are stored by super().save(), thumbnails - by the worker
+        if self.queue_thumbnails():
+            Product.objects.filter(pk=self.pk).update(
+                thumbnails=self.thumbnails, updated_at=self.updated_at)
 
     class Meta:
         """metaclass for Product model"""
         # IMPORTANT this param sets the sorting order for all shop pages
         # first: in_stock - no reserve - youngest
-        ordering = ['-in_stock', 'reserved', '-created_at']
+        # (id - unique key for keyset pagination of listings)
+        ordering = ['-in_stock', 'reserved', '-created_at', 'id']
+        indexes = [
+            # storefront listing: filter by flags + default ordering
+            models.Index(
+                fields=['-in_stock', 'reserved', '-created_at', 'id'],
+                condition=Q(is_tutorial=False, is_visible=True),
+                name='product_listing_idx',
+            ),
+            # 'sale' virtual category
+            models.Index(
+                fields=['-discount'],
+                condition=Q(in_stock=True, discount__gt=0),
+                name='product_sale_idx',
+            ),
+        ]
@@ -0,0 +1,25 @@
+"""
+Search document of a product: text of the product for the search index
+(see apps/catalog/search.py), kept in sync by signals
+"""
+from django.db import models
+from django.utils import timezone
+
+
+class ProductSearchDocument(models.Model):
+    """Searchable text of a product split by fields of different weight"""
+    # no DB constraint: row of deleted product is kept as a tombstone,
+    # so in-memory indexes of all processes can drop the product
+    product = models.OneToOneField(
+        'Product', primary_key=True, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='search_document')
+    title = models.TextField(blank=True)
+    categories = models.TextField(blank=True)
+    sizes = models.TextField(blank=True)
+    description = models.TextField(blank=True)
+    is_deleted = models.BooleanField(default=False)
+    # changes since the last sync are applied to in-memory indexes
+    updated = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return str(self.title)
@@ -0,0 +1,60 @@
+"""
+Model ThumbnailTask - durable queue of pictures waiting for thumbnails.
+Tasks are written in the same transaction as the saved product
+(see Product.save) and done later by 'generate_thumbnails --queued'
+management command, so the admin never waits for image processing.
+"""
+from django.db import models
+from django.utils import timezone
+
+
+class ThumbnailTask(models.Model):
+    """Picture of a product waiting for thumbnails generation"""
+    product = models.ForeignKey(
+        'Product', on_delete=models.CASCADE, related_name='thumbnail_tasks')
+    # picture field: the current picture is taken by the worker
+    field = models.CharField(max_length=20)
+    created = models.DateTimeField(default=timezone.now)
+
+    TASK_STATUSES = [
+        ('PENDING', 'Waiting for generation'),
+        ('FAILED', 'Failed (no more attempts)'),
+    ]
+    status = models.CharField(
+        max_length=10, default='PENDING', choices=TASK_STATUSES)
+    # attempts made and time of the next one (retry with backoff),
+    # a task queued again has no attempts
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['next_attempt', ]
+        constraints = [
+            # picture changed again before generation: one task
+            models.UniqueConstraint(fields=['product', 'field'],
+                                    name='thumbnail_task_unique_picture'),
+        ]
+        indexes = [
+            # worker: pending tasks which are due
+            models.Index(fields=['status', 'next_attempt'],
+                         name='thumbnail_task_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.field} of product {self.product_id}'
+
+    @classmethod
+    def queue(cls, product_id, fields):
+        """ Queue pictures of the product (again, if already queued)"""
+        now = timezone.now()
+        cls.objects.bulk_create(
+            [cls(product_id=product_id, field=field, created=now,
+                 next_attempt=now)
+             for field in fields],
+            update_conflicts=True,
+            # column names: ON CONFLICT gets the names as is (Django 4.1)
+            unique_fields=['product_id', 'field'],
+            update_fields=['created', 'status', 'attempts', 'next_attempt',
+                           'last_error'],
+        )
@@ -0,0 +1,132 @@
+"""
+Cached snapshot of the category navigation (menus of catalog and product pages
+and the header menu) with numbers of products of categories for badges.
+The whole tree is built once with a few queries and kept
+in the versioned catalog cache (see cache.py).
+"""
+from django.db.models import OuterRef
+from mptt.managers import SQCount
+
+from apps.catalog.cache import get_snapshot
+from apps.catalog.models import Category, Product
+
+
+class NavigationTree:
+    """ Snapshot of all categories with per-node products flags"""
+
+    def __init__(self, categories, with_products, sale_count):
+        # categories in tree order (tree_id, lft)
+        # with product_count: products listed at the category page
+        # (the whole subtree) for menu badges
+        self.categories = list(categories)
+        self.by_id = {node.pk: node for node in self.categories}
+        self.by_slug = {node.slug: node for node in self.categories}
+        # ids of categories having any products at all
+        self.with_products = frozenset(with_products)
+        # ids of categories having products shown at website
+        # (in stock or visible after sale) in their subtrees
+        self.with_displayable = frozenset(
+            node.pk for node in self.categories if node.product_count)
+        # number of products of 'virtual' sale category
+        self.has_sale = sale_count > 0
+        if sale := self.by_slug.get('sale'):
+            sale.product_count = sale_count
+
+    def get(self, slug):
+        """ Category by slug or None"""
+        return self.by_slug.get(slug)
+
+    def get_parent(self, node):
+        """ Parent category of the node without extra query"""
+        return self.by_id.get(node.parent_id)
+
+    def _sale_node(self):
+        sale = self.by_slug.get('sale')
+        if self.has_sale and sale and sale.visibility:
+            return sale
+        return None
+
+    @staticmethod
+    def _ordered(nodes):
+        return sorted(nodes, key=lambda node: (node.view_priority, node.title))
+
+    def roots(self):
+        """ Root non-empty visible categories for catalog pages
+        joined with 'virtual' sale category, except categories shown in header"""
+        nodes = [
+            node for node in self.categories
+            if node.parent_id is None and node.visibility
+            and not node.show_at_header and node.pk in self.with_displayable
+        ]
+        if (sale := self._sale_node()) and sale not in nodes:
+            nodes.append(sale)
+        return self._ordered(nodes)
+
+    def product_page_roots(self):
+        """ Root visible categories with products for product page
+        joined with 'virtual' sale category"""
+        nodes = [
+            node for node in self.categories
+            if node.parent_id is None and node.visibility
+            and node.pk in self.with_products
+        ]
+        if (sale := self._sale_node()) and sale not in nodes:
+            nodes.append(sale)
+        return self._ordered(nodes)
+
+    def branches(self, root):
+        """ Visible children of the root with products shown at website"""
+        return self._ordered(
+            node for node in self.categories
+            if node.parent_id == root.pk and node.visibility
+            and not node.show_at_header and node.pk in self.with_displayable
+        )
+
+    def header_categories(self):
+        """ Root categories specially marked for showing in header menu"""
+        return self._ordered(
+            node for node in self.categories
+            if node.parent_id is None and node.visibility
+            and node.show_at_header and node.pk in self.with_products
+        )
+
+
+def _subtree_count(**product_filters):
+    """ Number of products of the category and its descendants
+    (subquery on MPTT range, products of several categories counted once)"""
+    links = Product.category.through.objects.filter(
+        category__tree_id=OuterRef('tree_id'),
+        category__lft__gte=OuterRef('lft'),
+        category__lft__lte=OuterRef('rght'),
+        **{f'product__{name}': value
+           for name, value in product_filters.items()},
+    )
+    return SQCount(links.values('product_id').distinct())
+
+
+def build_navigation():
+    """ Build navigation snapshot from DB (3 queries)"""
+    categories = list(Category.objects.annotate(
+        beads_count=_subtree_count(is_visible=True, is_tutorial=False),
+        tutorials_count=_subtree_count(is_tutorial=True),
+    ))
+    # listing of 'tutorials' category has tutorials only, other - beads
+    tutorials = next(
+        (node for node in categories if node.slug == 'tutorials'), None)
+    for node in categories:
+        in_tutorials = tutorials is not None and (
+            node.tree_id == tutorials.tree_id
+            and tutorials.lft <= node.lft <= tutorials.rght)
+        node.product_count = (
+            node.tutorials_count if in_tutorials else node.beads_count)
+    with_products = (
+        Product.category.through.objects
+        .values_list('category_id', flat=True).distinct()
+    )
+    sale_count = Product.objects.filter(in_stock=True, discount__gt=0).count()
+    return NavigationTree(categories, with_products, sale_count)
+
+
+def get_navigation():
+    """ Get navigation snapshot (no queries while catalog is not changed)"""
+    return get_snapshot('navigation', build_navigation)
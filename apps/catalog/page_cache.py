@@ -0,0 +1,125 @@
+"""
+HTTP caching of catalog pages (catalog, product and static pages).
+A page depends on the catalog data (its version in cache.py)
+and on the visitor's cart only, so:
+- every page has ETag of (catalog version, url, cart content)
+  and Last-Modified of the catalog; not changed page is answered by 304
+- visitors without cart and session (nothing personal) get the public
+  variant of page, rendered once per catalog version and kept in
+  the full-page cache. Public page has no CSRF token: it is taken with
+  the cart badge and card buttons from personal fragment endpoint
+  (see apps/cart/views/personal.py) by a small script in base.html.
+  The page is keyed by its path and the parameters pages depend on:
+  'after' cursor and the normalized facet selection. Other parameters
+  (utm_* tags, junk) don't make new copies of the page.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers,
+)
+from django.utils.http import http_date, quote_etag
+
+from apps.cart.middleware import CART_COOKIE_NAME
+from apps.catalog.cache import get_catalog_modified, get_catalog_version
+from apps.catalog.facets import parse_selection, selection_query
+from apps.catalog.promotions import get_promo_seed
+from utils import get_cart_content
+
+PAGE_KEY = 'catalog:page:{version}:{digest}'
+# public pages are rendered again at least this often
+# (new sample of promotions)
+PAGE_TIMEOUT = 300
+
+
+def is_public_request(request):
+    """ GET of a visitor without cart, session and messages:
+    the page is the same for all such visitors"""
+    return (
+        request.method in ('GET', 'HEAD')
+        and CART_COOKIE_NAME not in request.COOKIES
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and not len(messages.get_messages(request))
+    )
+
+
+def _digest(*parts):
+    return hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def _page_url(request):
+    """ Path with the query parameters the page depends on"""
+    return (f'{request.path}?after={request.GET.get("after", "")}'
+            f'&{selection_query(parse_selection(request.GET))}')
+
+
+def _cart_state(request):
+    cart, product_ids = get_cart_content(request)
+    return f'{cart.pk}:{",".join(map(str, sorted(product_ids)))}'
+
+
+def catalog_page(view, personal=True):
+    """ Conditional GET and full-page cache for the public variant
+    of a catalog page view. personal=False - the page doesn't show
+    the cart (static pages)"""
+
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        public = is_public_request(request)
+        # messages are shown once: the page is not the same next time
+        if not public and len(messages.get_messages(request)):
+            return view(request, *args, **kwargs)
+
+        version = get_catalog_version()
+        page = _digest(
+            getattr(settings, 'PAGE_CACHE_REVISION', ''),
+            get_promo_seed(), _page_url(request))
+        state = ('public' if public or not personal
+                 else _cart_state(request))
+        etag = quote_etag(_digest(version, page, state))
+        last_modified = get_catalog_modified()
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = (_get_public_page(request, view, version, page,
+                                         *args, **kwargs)
+                        if public else view(request, *args, **kwargs))
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            # may be stored, but is checked by the browser every time
+            if public:
+                patch_cache_control(response, no_cache=True, public=True)
+            else:
+                patch_cache_control(response, no_cache=True, private=True)
+        # the public variant is for requests without cart/session cookies
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    return wrapped
+
+
+def _get_public_page(request, view, version, page, *args, **kwargs):
+    """ Public variant of page from the full-page cache,
+    rendered with no CSRF token (see _csrf_field.html)"""
+    key = PAGE_KEY.format(version=version, digest=page)
+    cached = cache.get(key)
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+    request.is_public_page = True
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    if response.status_code == 200:
+        cache.set(key, (response.content, response['Content-Type']),
+                  PAGE_TIMEOUT)
+    return response
@@ -0,0 +1,98 @@
+"""
+Keyset (seek) pagination for product listings.
+Next page is selected by the sort key of the last shown product,
+so any page costs O(page size) - no OFFSET scan of previous pages.
+The cursor is an opaque signed token with the sort key values.
+"""
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.http import Http404
+
+CURSOR_SALT = 'catalog.pagination.cursor'
+
+
+class KeysetPage:
+    """ A page of objects with a cursor for the next page"""
+
+    def __init__(self, object_list, has_next, ordering):
+        self.object_list = object_list
+        self._has_next = has_next
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    @property
+    def next_cursor(self):
+        """ Token for 'after' parameter of the next page"""
+        if not self._has_next:
+            return None
+        last = self.object_list[-1]
+        values = [getattr(last, name.lstrip('-')) for name in self.ordering]
+        return signing.dumps(
+            [v.isoformat() if hasattr(v, 'isoformat') else v for v in values],
+            salt=CURSOR_SALT,
+        )
+
+
+def get_ordering(queryset):
+    """ Ordering of queryset with pk as the last (unique) key"""
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    if not {'pk', '-pk', 'id', '-id'} & set(ordering):
+        ordering.append('pk')
+    return ordering
+
+
+def _decode_cursor(queryset, ordering, cursor):
+    """ Sort key values from cursor token (404 for broken token)"""
+    try:
+        values = signing.loads(cursor, salt=CURSOR_SALT)
+        if len(values) != len(ordering):
+            raise ValueError
+        decoded = []
+        for name, value in zip(ordering, values):
+            try:
+                field = queryset.model._meta.get_field(name.lstrip('-'))
+                value = field.to_python(value)
+            except FieldDoesNotExist:
+                # pk alias or annotation - JSON value as is
+                pass
+            decoded.append(value)
+        return decoded
+    except (signing.BadSignature, ValueError, TypeError, ValidationError):
+        raise Http404('Invalid page cursor')
+
+
+def paginate_after(queryset, page_size, cursor=None):
+    """ Page of queryset following the object encoded in cursor"""
+    ordering = get_ordering(queryset)
+    queryset = queryset.order_by(*ordering)
+    # one extra object shows whether the next page exists
+    limit = page_size + 1
+    if not cursor:
+        objects = list(queryset[:limit])
+    else:
+        values = _decode_cursor(queryset, ordering, cursor)
+        # rows 'after' (x, y, z) in sort order are consecutive groups:
+        # (a=x, b=y, c>z), then (a=x, b>y), then (a>x) ('<' for '-field').
+        # Each group is a range seek on the index (equal prefix + range),
+        # so groups are fetched one by one until the page is full.
+        objects = []
+        for depth in range(len(ordering), 0, -1):
+            prefix = {}
+            for name, value in zip(ordering[:depth - 1], values):
+                # '__in' (not '=') keeps boolean columns index-seekable
+                prefix[f'{name.lstrip("-")}__in'] = [value]
+            name = ordering[depth - 1]
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            prefix[f'{name.lstrip("-")}__{lookup}'] = values[depth - 1]
+            objects += queryset.filter(**prefix)[:limit - len(objects)]
+            if len(objects) == limit:
+                break
+    return KeysetPage(objects[:page_size], len(objects) > page_size, ordering)
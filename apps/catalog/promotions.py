@@ -0,0 +1,63 @@
+"""
+Selection of items for the promotions section of catalog pages.
+Candidates (promoted items and top-priced available items) are taken
+from DB once and kept in the versioned catalog cache (see cache.py),
+so each request only draws a random sample from the pool in memory.
+"""
+import random
+import time
+
+from django.conf import settings
+
+from apps.catalog.cache import get_snapshot
+from apps.catalog.models import Product
+
+PROMO_ITEMS_NUMBER = 8
+# max number of promoted items in the pool
+PROMOTED_POOL_SIZE = 100
+# number of top-priced items to fill the section if not enough promoted
+ADDITIONAL_POOL_SIZE = 16
+
+
+def build_promo_pool():
+    """ Candidates for promotions section (2 queries)"""
+    available = Product.objects.filter(in_stock=True, reserved=False)
+    promoted = list(
+        available.filter(promoted=True)
+        .order_by('-created_at')[:PROMOTED_POOL_SIZE]
+    )
+    additional = []
+    if len(promoted) < PROMO_ITEMS_NUMBER:
+        additional = list(
+            available.filter(promoted=False)
+            .order_by('-base_price')[:ADDITIONAL_POOL_SIZE]
+        )
+    return {'promoted': promoted, 'additional': additional}
+
+
+def get_promo_seed():
+    """ Seed for random sample: None - new sample for every request
+    (PROMO_SAMPLING = 'request'), or the number of current time window
+    for the same sample during PROMO_WINDOW seconds ('window')"""
+    if getattr(settings, 'PROMO_SAMPLING', 'request') == 'window':
+        return int(time.time() // getattr(settings, 'PROMO_WINDOW', 300))
+    return None
+
+
+def get_promo_items(seed=None):
+    """ 8 items to promo section: firsts 'promoted' items,
+    if missing, 16 max-priced items are taken randomly to combine
+    with promoted. get no errors if not enough items. shuffle result.
+    The same seed gives the same items while catalog is not changed."""
+    pool = get_snapshot('promotions', build_promo_pool)
+    rand = random.Random(seed)
+    promoted = pool['promoted']
+    if len(promoted) >= PROMO_ITEMS_NUMBER:
+        promo_items = rand.sample(promoted, PROMO_ITEMS_NUMBER)
+    else:
+        additional = pool['additional']
+        promo_items = promoted + rand.sample(
+            additional,
+            min(len(additional), PROMO_ITEMS_NUMBER - len(promoted)))
+    rand.shuffle(promo_items)
+    return promo_items
@@ -0,0 +1,345 @@
+"""
+Full-text search of products.
+Text of every product (title, categories, sizes, description) is kept
+in ProductSearchDocument rows, updated by signals (see signals.py).
+Documents are searched by the native full-text search of PostgreSQL
+(GIN index created after migrate) or by the in-memory inverted index
+(fallback for other databases, e.g. SQLite in development).
+The in-memory index of every process is built once and then updated
+with documents changed since its last sync (at most once a second).
+Search is AND of query terms ranked by field weights (title first),
+the last term matches as a prefix (type-ahead).
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+from sys import intern
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from apps.catalog.models import Product, ProductSearchDocument
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+# weights of document fields for ranking
+FIELD_WEIGHTS = {'title': 4, 'categories': 2, 'sizes': 2, 'description': 1}
+# score of a term found by prefix only (not the whole word)
+PREFIX_MATCH_WEIGHT = 0.5
+# a short prefix matches too many terms: only the most frequent are used
+MAX_PREFIX_EXPANSIONS = 30
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# documents committed a bit later than their 'updated' time
+# are taken by the next syncs too
+SYNC_OVERLAP = timedelta(seconds=60)
+# search results may be behind the documents by this time
+SYNC_INTERVAL = timedelta(seconds=1)
+INDEX_CHUNK_SIZE = 1000
+
+
+def tokenize(text):
+    """ Lowercase words and numbers of the text"""
+    return TOKEN_RE.findall(text.casefold()) if text else []
+
+
+def _sizes_text(size_1, size_2, size_3):
+    sizes = [str(size) for size in (size_1, size_2, size_3) if size]
+    if not sizes:
+        return ''
+    # '10 12 mm 10x12': each size is a term, as well as the whole size
+    return ' '.join(sizes + ['mm', 'x'.join(sizes)])
+
+
+def build_documents(product_ids):
+    """ Search documents of existing products (2 queries)"""
+    categories = defaultdict(list)
+    for product_id, title in Product.category.through.objects.filter(
+            product_id__in=product_ids).values_list(
+            'product_id', 'category__title'):
+        categories[product_id].append(title)
+    return [
+        ProductSearchDocument(
+            product_id=product['pk'],
+            title=product['title'],
+            categories=' '.join(categories[product['pk']]),
+            sizes=_sizes_text(
+                product['size_1'], product['size_2'], product['size_3']),
+            description=strip_tags(product['description'] or ''),
+        )
+        for product in Product.objects.filter(pk__in=product_ids).values(
+            'pk', 'title', 'description', 'size_1', 'size_2', 'size_3')
+    ]
+
+
+def index_products(product_ids):
+    """ Create or update search documents of products,
+    documents of not existing products are marked as deleted"""
+    product_ids = list(product_ids)
+    now = timezone.now()
+    for start in range(0, len(product_ids), INDEX_CHUNK_SIZE):
+        chunk = product_ids[start:start + INDEX_CHUNK_SIZE]
+        documents = build_documents(chunk)
+        for document in documents:
+            document.updated = now
+        ProductSearchDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            # column name: ON CONFLICT gets the names as is (Django 4.1)
+            unique_fields=['product_id'],
+            update_fields=['title', 'categories', 'sizes', 'description',
+                           'is_deleted', 'updated'],
+        )
+        found = {document.product_id for document in documents}
+        remove_products(pk for pk in chunk if pk not in found)
+
+
+def remove_products(product_ids):
+    """ Mark search documents of deleted products"""
+    product_ids = list(product_ids)
+    if product_ids:
+        ProductSearchDocument.objects.filter(product_id__in=product_ids).update(
+            is_deleted=True, updated=timezone.now())
+
+
+class InvertedIndex:
+    """ In-memory index: term -> {product id: weighted term frequency}"""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        # product id -> (terms, updated) for updates of the document
+        self.documents = {}
+        # product id -> document length (sum of weighted frequencies)
+        self.lengths = {}
+        self.total_length = 0
+        # sorted terms for prefix lookups, rebuilt after new terms added
+        self._sorted_terms = []
+        self._has_new_terms = False
+
+    def add(self, product_id, texts, updated):
+        """ Add or replace a document: texts of FIELD_WEIGHTS fields"""
+        self.remove(product_id)
+        frequencies = {}
+        for text, weight in zip(texts, FIELD_WEIGHTS.values()):
+            for term in tokenize(text):
+                frequencies[term] = frequencies.get(term, 0) + weight
+        # one string object per term for all documents (memory)
+        frequencies = {intern(term): frequency
+                       for term, frequency in frequencies.items()}
+        postings = self.postings
+        for term, frequency in frequencies.items():
+            if term not in postings:
+                self._has_new_terms = True
+            postings[term][product_id] = frequency
+        length = sum(frequencies.values())
+        self.documents[product_id] = (tuple(frequencies), updated)
+        self.lengths[product_id] = length
+        self.total_length += length
+
+    def remove(self, product_id):
+        terms, _ = self.documents.pop(product_id, ((), None))
+        self.total_length -= self.lengths.pop(product_id, 0)
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(product_id, None)
+            if not postings:
+                # stays in sorted terms until rebuild: lookups check it
+                del self.postings[term]
+
+    def updated(self, product_id):
+        """ 'updated' time of the indexed document (None if not indexed)"""
+        return self.documents.get(product_id, ((), None))[1]
+
+    def expand(self, term, prefix):
+        """ Index terms matching the query term: {term: weight},
+        prefix matches are limited to the most frequent terms"""
+        matches = {}
+        if term in self.postings:
+            matches[term] = 1
+        if prefix:
+            if self._has_new_terms:
+                self._sorted_terms = sorted(self.postings)
+                self._has_new_terms = False
+            start = bisect.bisect_left(self._sorted_terms, term)
+            candidates = []
+            for candidate in self._sorted_terms[start:]:
+                if not candidate.startswith(term):
+                    break
+                if candidate != term and candidate in self.postings:
+                    candidates.append(candidate)
+            for candidate in heapq.nlargest(
+                    MAX_PREFIX_EXPANSIONS, candidates,
+                    key=lambda candidate: len(self.postings[candidate])):
+                matches[candidate] = PREFIX_MATCH_WEIGHT
+        return matches
+
+    def search(self, terms, limit, prefix=True):
+        """ Product ids having all terms ranked by BM25 score"""
+        if not terms or not self.documents:
+            return []
+        expanded = [
+            self.expand(term, prefix and position == len(terms) - 1)
+            for position, term in enumerate(terms)
+        ]
+        if not all(expanded):
+            return []
+        # the rarest term first: fewer candidates to check for the others
+        expanded.sort(key=lambda matches: sum(
+            len(self.postings[match]) for match in matches))
+        number = len(self.documents)
+        lengths = self.lengths
+        # BM25 length normalization: constant + factor * document length
+        norm_constant = BM25_K1 * (1 - BM25_B)
+        norm_factor = BM25_K1 * BM25_B * number / self.total_length
+        scores = None
+        for matches in expanded:
+            term_scores = defaultdict(float)
+            for match, match_weight in matches.items():
+                postings = self.postings[match]
+                idf = math.log(1 + (number - len(postings) + 0.5)
+                               / (len(postings) + 0.5))
+                weight = match_weight * idf * (BM25_K1 + 1)
+                if scores is None or len(postings) <= len(scores):
+                    items = postings.items()
+                else:
+                    # AND: only candidates found by the previous terms
+                    items = ((product_id, postings[product_id])
+                             for product_id in scores
+                             if product_id in postings)
+                for product_id, frequency in items:
+                    term_scores[product_id] += weight * frequency / (
+                        frequency + norm_constant
+                        + norm_factor * lengths[product_id])
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {
+                    product_id: score + term_scores[product_id]
+                    for product_id, score in scores.items()
+                    if product_id in term_scores
+                }
+            if not scores:
+                return []
+        ranked = heapq.nsmallest(
+            limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in ranked]
+
+
+class PythonSearchEngine:
+    """ Search by in-memory inverted index synced with search documents"""
+
+    def __init__(self):
+        self.index = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """ Build the index or apply documents changed since the last sync
+        (not more often than SYNC_INTERVAL)"""
+        now = timezone.now()
+        if self.index is not None and now - self.synced_at < SYNC_INTERVAL:
+            return
+        documents = ProductSearchDocument.objects.all()
+        # plain tuples: much cheaper than model instances for 100k rows
+        fields = ['product_id', *FIELD_WEIGHTS, 'updated', 'is_deleted']
+        if self.index is None:
+            self.index = InvertedIndex()
+            changed = [documents.filter(is_deleted=False).values_list(
+                *fields).iterator(chunk_size=INDEX_CHUNK_SIZE)]
+        else:
+            # cheap check of the overlap first: texts of changed only
+            recent = documents.filter(
+                updated__gte=self.synced_at - SYNC_OVERLAP).values_list(
+                'product_id', 'updated')
+            changed_ids = [
+                product_id for product_id, updated in recent
+                if updated != self.index.updated(product_id)
+            ]
+            changed = (
+                documents.filter(product_id__in=changed_ids[
+                    start:start + INDEX_CHUNK_SIZE]).values_list(*fields)
+                for start in range(0, len(changed_ids), INDEX_CHUNK_SIZE)
+            )
+        for rows in changed:
+            for product_id, *texts, updated, is_deleted in rows:
+                if is_deleted:
+                    self.index.remove(product_id)
+                else:
+                    self.index.add(product_id, texts, updated)
+        self.synced_at = now
+
+    def search(self, terms, limit, prefix=True):
+        with self.lock:
+            self.sync()
+            return self.index.search(terms, limit, prefix)
+
+
+class PostgresSearchEngine:
+    """ Search by native full-text search of PostgreSQL"""
+    # the same expression is used for GIN index and queries
+    VECTOR_SQL = ' || '.join(
+        f"setweight(to_tsvector('simple'::regconfig, "
+        f"coalesce({field}, '')), '{weight}')"
+        for field, weight in (('title', 'A'), ('categories', 'B'),
+                              ('sizes', 'B'), ('description', 'C'))
+    )
+    INDEX_NAME = 'product_search_document_gin'
+
+    def search(self, terms, limit, prefix=True):
+        if not terms:
+            return []
+        # terms are words/numbers only: no operators of tsquery syntax
+        query = ' & '.join(terms[:-1] + [
+            f'{terms[-1]}:*' if prefix else terms[-1]])
+        table = ProductSearchDocument._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {table}, "
+                f"to_tsquery('simple'::regconfig, %s) AS query "
+                f"WHERE NOT is_deleted AND ({self.VECTOR_SQL}) @@ query "
+                f"ORDER BY ts_rank({self.VECTOR_SQL}, query) DESC, product_id "
+                f"LIMIT %s",
+                [query, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def create_index(cls, using):
+        """ GIN index on the document vector (after migrate)"""
+        table = ProductSearchDocument._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {cls.INDEX_NAME} '
+                f'ON {table} USING gin (({cls.VECTOR_SQL}))')
+
+
+_engines = {}
+
+
+def get_search_engine():
+    """ Engine by CATALOG_SEARCH_ENGINE setting:
+    'auto' - native for PostgreSQL, in-memory index for others"""
+    name = getattr(settings, 'CATALOG_SEARCH_ENGINE', 'auto')
+    if name == 'auto':
+        name = 'postgres' if connection.vendor == 'postgresql' else 'python'
+    if name not in _engines:
+        _engines[name] = (PostgresSearchEngine() if name == 'postgres'
+                          else PythonSearchEngine())
+    return _engines[name]
+
+
+def search_product_ids(query, limit, prefix=True):
+    """ Ids of products matching the query, the best first"""
+    return get_search_engine().search(tokenize(query), limit, prefix)
+
+
+def create_native_index(sender, using, **kwargs):
+    """ post_migrate handler: GIN index for PostgreSQL search"""
+    if connections[using].vendor == 'postgresql':
+        PostgresSearchEngine.create_index(using)
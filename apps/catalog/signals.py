@@ -0,0 +1,121 @@
+"""
+Signal handlers keeping cached catalog data (navigation menus, promotions)
+and search documents in sync with Category and Product changes
+"""
+from django.db.models import Q
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete,
+)
+from django.dispatch import receiver
+
+from apps.catalog import search
+from apps.catalog.cache import invalidate_catalog
+from apps.catalog.models import Category, Product
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def catalog_changed(sender, **kwargs):
+    """ Any change of categories or products may change cached data"""
+    invalidate_catalog(categories=sender is Category)
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def product_categories_changed(sender, instance, action, reverse, pk_set,
+                               **kwargs):
+    """ Product was added to or removed from categories:
+    update denormalized is_tutorial flag and cached data"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # instance is a Product
+        Product.objects.filter(pk=instance.pk).sync_tutorial_flags()
+        instance.is_tutorial = (
+            Product.objects.filter(pk=instance.pk, is_tutorial=True).exists())
+        if instance.is_tutorial:
+            instance.reserved = False
+    elif pk_set:
+        # instance is a Category, pk_set - products
+        Product.objects.filter(pk__in=pk_set).sync_tutorial_flags()
+    else:
+        # all products were removed from the Category (unknown which)
+        Product.objects.filter(is_tutorial=True).sync_tutorial_flags()
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    """ Slug of the category may be changed to or from 'tutorials':
+    update is_tutorial flag of its products and of current tutorials"""
+    products = Product.category.through.objects.filter(
+        category=instance).values('product_id')
+    Product.objects.filter(
+        Q(pk__in=products) | Q(is_tutorial=True)).sync_tutorial_flags()
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, **kwargs):
+    """ Links to products are deleted by cascade without m2m_changed:
+    remember products of 'tutorials' category before it"""
+    if instance.slug == 'tutorials':
+        instance.tutorial_product_ids = list(
+            instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    """ Products of deleted 'tutorials' category are not tutorials anymore"""
+    product_ids = getattr(instance, 'tutorial_product_ids', None)
+    if product_ids:
+        Product.objects.filter(pk__in=product_ids).sync_tutorial_flags()
+
+
+@receiver(post_save, sender=Product)
+def product_saved_index(sender, instance, **kwargs):
+    """ Update search document of the product"""
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted_index(sender, instance, **kwargs):
+    """ Drop the product from search indexes"""
+    search.remove_products([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def product_categories_changed_index(sender, instance, action, reverse,
+                                     pk_set, **kwargs):
+    """ Category titles are a part of search documents of products"""
+    if action == 'pre_clear' and reverse:
+        # products of the category are unknown after clear
+        instance.cleared_product_ids = list(
+            instance.products.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            search.index_products([instance.pk])
+        elif pk_set:
+            search.index_products(pk_set)
+        else:
+            search.index_products(getattr(instance, 'cleared_product_ids', []))
+
+
+@receiver(post_save, sender=Category)
+def category_saved_index(sender, instance, created, **kwargs):
+    """ Title of the category may be changed"""
+    if not created:
+        search.index_products(instance.products.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting_index(sender, instance, **kwargs):
+    """ Links to products are deleted by cascade without m2m_changed:
+    remember products of the category before it"""
+    instance.indexed_product_ids = list(
+        instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted_index(sender, instance, **kwargs):
+    search.index_products(getattr(instance, 'indexed_product_ids', []))
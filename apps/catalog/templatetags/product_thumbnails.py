@@ -0,0 +1,59 @@
+"""
+Custom template filter for thumbnails urls of product pictures
+taken from thumbnails manifest of the product (no storage I/O)
+and tag of responsive picture with renditions and placeholder
+"""
+from django import template
+from django.utils.html import format_html, format_html_join
+
+register = template.Library()
+
+
+@register.filter
+def product_thumbnail(product, alias):
+    """ {{ product|product_thumbnail:'medium' }} - thumbnail of picture_1,
+    {{ product|product_thumbnail:'picture_2:small' }} - of other picture"""
+    field, _, alias = alias.rpartition(':')
+    return product.get_thumbnail_url(alias, field or 'picture_1')
+
+
+@register.simple_tag
+def product_picture(product, alias, sizes, field='picture_1', alt='',
+                    css_class='', lazy=True, **attrs):
+    """ <picture> with srcset of renditions (see images.py) for
+    the rendered width 'sizes' and thumbnail of alias ('' - original
+    picture) for browsers without the formats. Placeholder colour
+    and preview are painted until the image is loaded:
+    {% product_picture product 'medium' '280px' css_class='card-img-top' %}
+    """
+    picture = getattr(product, field)
+    if not picture:
+        return ''
+    src = product.get_thumbnail_url(alias, field) if alias else picture.url
+    entry = product.thumbnails.get(field, {})
+    if entry.get('name') != picture.name:
+        entry = {}
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((mime, ', '.join(f'{url} {width}w' for width, url in widths), sizes)
+         for mime, widths in entry.get('srcset', {}).items()),
+    )
+    # intrinsic size: the page doesn't jump when the image is loaded
+    if 'width' in entry:
+        attrs.setdefault('width', entry['width'])
+        attrs.setdefault('height', entry['height'])
+    if 'color' in entry:
+        attrs['style'] = (
+            f"background: {entry['color']} url('{entry['placeholder']}') "
+            f"center / cover no-repeat")
+    if lazy:
+        attrs['loading'] = 'lazy'
+    else:
+        # largest image of the page (LCP): loaded first
+        attrs['fetchpriority'] = 'high'
+    return format_html(
+        '<picture>{}<img src="{}" alt="{}" class="{}" decoding="async"{}>'
+        '</picture>',
+        sources, src, alt, css_class,
+        format_html_join('', ' {}="{}"', sorted(attrs.items())),
+    )
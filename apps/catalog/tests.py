@@ -0,0 +1,722 @@
+"""
+Tests for catalog pages: number of queries must not depend on cart size,
+HTTP caching; facets, product search, queued thumbnails,
+per-request instrumentation
+"""
+import glob
+import io
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Case, F, Q, Value, When
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import QueryDict
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from apps.cart.middleware import CART_COOKIE_NAME, sign_cart_token
+from apps.cart.models import Cart, CartItem
+from apps.catalog import cache as catalog_cache
+from apps.catalog.admin import ProductAdmin
+from apps.catalog.cache import get_catalog_version
+from apps.catalog.facets import (
+    build_facet_summary, filter_products, parse_selection, selection_query,
+)
+from apps.catalog.models import Category, Product, ThumbnailTask
+from apps.catalog.navigation import get_navigation
+from apps.catalog.search import PythonSearchEngine, tokenize
+from instrumentation import RequestMetrics, registry
+
+MEDIA_ROOT = tempfile.mkdtemp()
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+
+def make_picture(name='bead.jpg', size=(75, 75), **options):
+    """ Small jpeg for a product picture"""
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, 'JPEG', **options)
+    return SimpleUploadedFile(name, buffer.getvalue(), 'image/jpeg')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES)
+class PageQueriesTest(TestCase):
+    """ Category and product pages run a fixed number of queries
+    for an empty cart and for a large one"""
+    PRODUCTS_NUMBER = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.products = []
+        picture = make_picture()
+        for i in range(cls.PRODUCTS_NUMBER):
+            product = Product(
+                title=f'Bead {i}', slug=f'bead-{i}', base_price=10 + i,
+                discount=10 if i % 5 == 0 else 0, promoted=i % 7 == 0,
+                picture_1=(picture if i == 0
+                           else cls.products[0].picture_1.name),
+            )
+            product.save()
+            product.category.add(cls.beads)
+            cls.products.append(product)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def fill_cart(self, products):
+        """ Put products to the cart of the test client (cart cookie)"""
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create(
+            CartItem(cart=cart, product=product, price=product.price)
+            for product in products
+        )
+        self.client.cookies[CART_COOKIE_NAME] = sign_cart_token(cart.token)
+
+    def assert_page_queries(self, url, number):
+        # the first request fills navigation, promotions and cards caches
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(number):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_empty_cart(self):
+        # visitor without cart: public page from full-page cache
+        self.assert_page_queries('/catalog/beads/', 0)
+        self.assert_page_queries('/product/bead-1/', 0)
+
+    def test_one_item_cart(self):
+        self.fill_cart(self.products[:1])
+        self.assert_page_queries('/catalog/beads/', 3)
+        self.assert_page_queries('/product/bead-1/', 3)
+
+    def test_large_cart(self):
+        self.fill_cart(self.products)
+        self.assert_page_queries('/catalog/beads/', 3)
+        self.assert_page_queries('/product/bead-1/', 3)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES)
+class PageCachingTest(TestCase):
+    """ Conditional GET of catalog pages and full-page cache
+    for visitors without cart"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.bead = Product.objects.create(
+            title='Bead', slug='bead', base_price=10,
+            picture_1=make_picture())
+        cls.bead.category.add(cls.beads)
+
+    def setUp(self):
+        cache.clear()
+
+    def assert_not_modified(self, url, response):
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    def cached_pages(self):
+        return sum(':catalog:page:' in key for key in cache._cache)
+
+    def test_public_page(self):
+        for url in ('/', '/catalog/beads/', '/product/bead/', '/about/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('public', response['Cache-Control'])
+            self.assertNotIn('csrftoken', response.cookies)
+            self.assert_not_modified(url, response)
+
+    def test_query_parameters(self):
+        response = self.client.get('/catalog/beads/?hole=HOR&size=0')
+        for url in ('/catalog/beads/?utm_source=mail&hole=HOR',
+                    '/catalog/beads/?hole=HOR&hole=junk&x=1'):
+            self.assert_not_modified(url, response)
+        self.assertEqual(self.cached_pages(), 1)
+        self.client.get('/catalog/beads/?hole=VERT')
+        self.assertEqual(self.cached_pages(), 2)
+
+    def test_catalog_change(self):
+        response = self.client.get('/product/bead/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bead.title = 'Red bead'
+            self.bead.save()
+        changed = self.client.get(
+            '/product/bead/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertContains(changed, 'Red bead')
+
+    def test_cart_change(self):
+        self.client.post('/add_item/', {'product_pk': self.bead.pk})
+        response = self.client.get('/catalog/beads/')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertContains(response, 'remove')
+        self.assert_not_modified('/catalog/beads/', response)
+        self.client.post('/remove_item/', {'product_pk': self.bead.pk})
+        changed = self.client.get(
+            '/catalog/beads/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertContains(changed, 'add to cart')
+
+    def test_personal_fragment(self):
+        self.assertEqual(
+            self.client.get('/personal/').json()['cart_product_ids'], [])
+        self.client.post('/add_item/', {'product_pk': self.bead.pk})
+        data = self.client.get('/personal/').json()
+        self.assertEqual(data['cart_count'], 1)
+        self.assertEqual(data['cart_product_ids'], [self.bead.pk])
+        self.assertTrue(data['csrf_token'])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+})
+class DummyCacheTest(TestCase):
+    """ Pages work with a cache keeping nothing: catalog version
+    of the process"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.bead = Product.objects.create(
+            title='Bead', slug='bead', base_price=10,
+            picture_1=make_picture())
+        cls.bead.category.add(cls.beads)
+
+    def setUp(self):
+        catalog_cache._local_cache.clear()
+        catalog_cache._local_versions.clear()
+
+    def test_pages(self):
+        for url in ('/', '/catalog/beads/', '/product/bead/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Last-Modified'])
+        self.assertEqual(get_catalog_version(), get_catalog_version())
+
+    def test_catalog_change(self):
+        response = self.client.get('/catalog/beads/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bead.title = 'Red bead'
+            self.bead.save()
+        changed = self.client.get(
+            '/catalog/beads/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertContains(changed, 'Red bead')
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TutorialFlagsTest(TestCase):
+    """ Products of 'tutorials' category are never reserved,
+    whichever way they are changed"""
+
+    def setUp(self):
+        self.tutorials = Category.objects.create(
+            title='Tutorials', slug='tutorials')
+        self.beads = Category.objects.create(title='Beads', slug='beads')
+        self.bead, self.other = (
+            Product.objects.create(title=f'Bead {i}', slug=f'bead-{i}',
+                                   base_price=10, reserved=True)
+            for i in range(2))
+
+    def assert_flags(self, product, is_tutorial, reserved):
+        product.refresh_from_db()
+        self.assertEqual((product.is_tutorial, product.reserved),
+                         (is_tutorial, reserved))
+
+    def test_categories_of_product(self):
+        self.bead.category.add(self.tutorials)
+        self.assert_flags(self.bead, True, False)
+        self.bead.category.remove(self.tutorials)
+        self.assert_flags(self.bead, False, False)
+        self.bead.category.add(self.tutorials, self.beads)
+        self.bead.category.clear()
+        self.assert_flags(self.bead, False, False)
+
+    def test_products_of_category(self):
+        self.tutorials.products.add(self.bead, self.other)
+        self.assert_flags(self.bead, True, False)
+        self.assert_flags(self.other, True, False)
+        self.tutorials.products.remove(self.other)
+        self.assert_flags(self.other, False, False)
+        self.tutorials.products.clear()
+        self.assert_flags(self.bead, False, False)
+
+    def test_category_slug(self):
+        self.beads.products.add(self.bead)
+        self.tutorials.slug = 'old-tutorials'
+        self.tutorials.save()
+        self.beads.slug = 'tutorials'
+        self.beads.save()
+        self.assert_flags(self.bead, True, False)
+        self.beads.slug = 'beads'
+        self.beads.save()
+        self.assert_flags(self.bead, False, False)
+
+    def test_bulk_updates(self):
+        self.bead.category.add(self.tutorials)
+        Product.objects.update(reserved=True)
+        self.assert_flags(self.bead, True, False)
+        self.assert_flags(self.other, False, True)
+        Product.objects.update(reserved=False)
+        products = list(Product.objects.all())
+        for product in products:
+            product.reserved = True
+        Product.objects.bulk_update(products, ['reserved'])
+        self.assert_flags(self.bead, True, False)
+        self.assert_flags(self.other, False, True)
+
+
+class VisibilityFlagsTest(TestCase):
+    """ is_visible = in_stock or show_after_sale after bulk updates
+    with plain values and with expressions"""
+
+    def setUp(self):
+        self.sold, self.hidden = Product.objects.bulk_create(
+            Product(title=title, slug=title, base_price=10,
+                    show_after_sale=show)
+            for title, show in (('sold', True), ('hidden', False)))
+
+    def visible(self):
+        return dict(Product.objects.values_list('slug', 'is_visible'))
+
+    def test_plain_values(self):
+        Product.objects.update(in_stock=False)
+        self.assertEqual(self.visible(), {'sold': True, 'hidden': False})
+        Product.objects.update(show_after_sale=True)
+        self.assertEqual(self.visible(), {'sold': True, 'hidden': True})
+
+    def test_expressions(self):
+        Product.objects.update(in_stock=Case(
+            When(slug='nothing', then=Value(True)), default=Value(False)))
+        self.assertEqual(self.visible(), {'sold': True, 'hidden': False})
+        Product.objects.update(
+            in_stock=Value(False), show_after_sale=F('in_stock'))
+        self.assertEqual(self.visible(), {'sold': False, 'hidden': False})
+        Product.objects.update(in_stock=Q(slug='hidden'))
+        self.assertEqual(self.visible(), {'sold': False, 'hidden': True})
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SubtreeListingTest(TestCase):
+    """ Category page lists products of all its subcategories"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.round = Category.objects.create(
+            title='Round', slug='round', parent=cls.beads)
+        cls.small = Category.objects.create(
+            title='Small', slug='small', parent=cls.round)
+        cls.other = Category.objects.create(title='Other', slug='other')
+        products = Product.objects.bulk_create(
+            Product(title=f'Bead {i}', slug=f'bead-{i}', base_price=10)
+            for i in range(4)
+        )
+        products[0].category.add(cls.beads)
+        products[1].category.add(cls.round)
+        # in parent and child: listed and counted once
+        products[2].category.add(cls.small, cls.beads)
+        products[3].category.add(cls.other)
+        cls.products = products
+
+    def setUp(self):
+        cache.clear()
+
+    def test_listing(self):
+        for category, products in ((self.beads, self.products[:3]),
+                                   (self.round, self.products[1:3]),
+                                   (self.small, self.products[2:3])):
+            category.refresh_from_db()
+            self.assertCountEqual(
+                Product.objects.in_category(category), products)
+
+    def test_counts(self):
+        navigation = get_navigation()
+        counts = {slug: navigation.get(slug).product_count
+                  for slug in ('beads', 'round', 'small', 'other')}
+        self.assertEqual(
+            counts, {'beads': 3, 'round': 2, 'small': 1, 'other': 1})
+
+    def test_page(self):
+        response = self.client.get('/catalog/beads/')
+        self.assertCountEqual(response.context['object_list'], self.products[:3])
+
+
+class FacetsTest(TestCase):
+    """ Facet counts from the summary match filtered listings"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create(
+            Product(title=f'Bead {i}', slug=f'bead-{i}',
+                    hole_position=('VERT', 'HOR', 'NO')[i % 3],
+                    hole_size=(2, 3)[i % 2], size_1=10 + i % 4 * 2,
+                    base_price=5 + i * 3, discount=20 if i % 5 == 0 else 0)
+            for i in range(30)
+        )
+        cls.queryset = Product.objects.filter(is_visible=True)
+
+    def test_selection_is_normalized(self):
+        selection = parse_selection(QueryDict(
+            'size=12&hole=VERT&size=x&hole=UP&price=9&size=10&hole=VERT'))
+        self.assertEqual(selection_query(selection),
+                         'hole=VERT&size=10&size=12')
+
+    def test_counts(self):
+        summary = build_facet_summary(self.queryset)
+        for query in ('', 'hole=VERT', 'hole=VERT&hole=NO&mandrel=3',
+                      'size=12&price=1&price=4', 'price=0'):
+            selection = parse_selection(QueryDict(query))
+            self.assertEqual(
+                summary.total(selection),
+                filter_products(self.queryset, selection).count())
+            for facet in summary.facets(selection):
+                for option in facet['options']:
+                    # count of an option: products with the value
+                    # and selected values of other facets
+                    only_value = dict(selection)
+                    only_value[facet['param']] = {option['value']}
+                    self.assertEqual(
+                        option['count'],
+                        filter_products(self.queryset, only_value).count(),
+                        (query, option['query']))
+
+
+class SearchTest(TestCase):
+    """ In-memory search index built from documents kept by signals"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.focal = Category.objects.create(title='Focal beads', slug='focal')
+        cls.red = Product.objects.create(
+            title='Red lentil', slug='red-lentil', base_price=10,
+            size_1=12, size_2=14, description='<p>Turquoise dots</p>')
+        cls.turquoise = Product.objects.create(
+            title='Turquoise disc', slug='turquoise-disc', base_price=20)
+        cls.turquoise.category.add(cls.focal)
+
+    def search(self, query, prefix=True):
+        # new engine: the index is built from documents of the test
+        return PythonSearchEngine().search(tokenize(query), 10, prefix)
+
+    def test_title_is_ranked_first(self):
+        self.assertEqual(self.search('turquoise'),
+                         [self.turquoise.pk, self.red.pk])
+
+    def test_all_terms_are_required(self):
+        self.assertEqual(self.search('red dots'), [self.red.pk])
+        self.assertEqual(self.search('red disc'), [])
+
+    def test_prefix_of_last_term(self):
+        self.assertEqual(self.search('lent'), [self.red.pk])
+        self.assertEqual(self.search('lent', prefix=False), [])
+        self.assertEqual(self.search('turquoise fo'), [self.turquoise.pk])
+
+    def test_sizes(self):
+        self.assertEqual(self.search('12x14'), [self.red.pk])
+
+    def test_documents_follow_changes(self):
+        self.red.title = 'Amber lentil'
+        self.red.save()
+        self.focal.title = 'Spacers'
+        self.focal.save()
+        self.assertEqual(self.search('amber'), [self.red.pk])
+        self.assertEqual(self.search('spacers'), [self.turquoise.pk])
+        self.assertEqual(self.search('focal'), [])
+        self.turquoise.category.clear()
+        self.assertEqual(self.search('spacers'), [])
+        self.red.delete()
+        self.assertEqual(self.search('lentil'), [])
+
+    def test_incremental_sync(self):
+        engine = PythonSearchEngine()
+        self.assertEqual(engine.search(['amber'], 10), [])
+        self.red.title = 'Amber lentil'
+        self.red.save()
+        # next sync is not earlier than SYNC_INTERVAL
+        engine.synced_at -= timedelta(seconds=5)
+        self.assertEqual(engine.search(['amber'], 10), [self.red.pk])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES)
+class ThumbnailsTest(TestCase):
+    """ Pictures are queued by save and rendered by the worker"""
+
+    def setUp(self):
+        self.bead = Product.objects.create(
+            title='Bead', slug='bead', base_price=10,
+            picture_1=make_picture('queued.jpg'))
+
+    def generate(self, *args):
+        call_command('generate_thumbnails', '--processes', '1', *args,
+                     stdout=io.StringIO())
+        self.bead.refresh_from_db()
+
+    def test_queued_picture(self):
+        self.assertEqual(
+            list(self.bead.thumbnail_tasks.values_list('field', flat=True)),
+            ['picture_1'])
+        # original picture until thumbnails are generated
+        self.assertEqual(self.bead.get_thumbnail_url('small'),
+                         self.bead.picture_1.url)
+        self.generate('--queued')
+        url = self.bead.get_thumbnail_url('small')
+        self.assertNotEqual(url, self.bead.picture_1.url)
+        # thumbnails of both aliases and renditions are stored
+        # next to the picture
+        entry = self.bead.thumbnails['picture_1']
+        self.assertIn('image/webp', entry['srcset'])
+        self.assertEqual(
+            len(glob.glob(os.path.join(
+                MEDIA_ROOT, f'{self.bead.picture_1.name}.*'))),
+            2 + sum(map(len, entry['srcset'].values())))
+        self.assertFalse(ThumbnailTask.objects.exists())
+
+    def test_stale_pictures_only(self):
+        self.generate()
+        manifest = self.bead.thumbnails
+        self.assertIn('medium', manifest['picture_1'])
+        self.bead.picture_2 = make_picture('second.jpg')
+        self.bead.save()
+        self.generate()
+        self.assertEqual(self.bead.thumbnails['picture_1'],
+                         manifest['picture_1'])
+        self.assertIn('medium', self.bead.thumbnails['picture_2'])
+
+    def test_normalized_upload(self):
+        exif = Image.Exif()
+        # orientation: rotated 90 degrees
+        exif[0x0112] = 6
+        self.bead.picture_1 = make_picture(
+            'photo.png', size=(2000, 1000), exif=exif.tobytes())
+        self.bead.save()
+        with Image.open(self.bead.picture_1.path) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (750, 1500))
+            self.assertNotIn('exif', image.info)
+        self.assertTrue(self.bead.picture_1.name.endswith('.jpg'))
+
+    def test_responsive_picture(self):
+        html = Template(
+            "{% load product_thumbnails %}"
+            "{% product_picture product 'medium' '280px' alt='Bead' %}"
+        ).render(Context({'product': self.bead}))
+        # pending: the picture itself, no renditions yet
+        self.assertIn(f'src="{self.bead.picture_1.url}"', html)
+        self.assertNotIn('<source', html)
+        self.generate('--queued')
+        html = Template(
+            "{% load product_thumbnails %}"
+            "{% product_picture product 'medium' '280px' alt='Bead' %}"
+        ).render(Context({'product': self.bead}))
+        self.assertIn('<source type="image/webp" srcset="', html)
+        self.assertIn(' 75w" sizes="280px">', html)
+        self.assertIn('height="75"', html)
+        self.assertIn('width="75"', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('data:image/webp;base64,', html)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class AdminActionsTest(TestCase):
+    """ Bulk price actions of the product list: one UPDATE for the whole
+    selection, values checked to be in range"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.products = Product.objects.bulk_create(
+            Product(title=f'Bead {i}', slug=f'bead-{i}', base_price=100)
+            for i in range(3))
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.beads.products.add(*cls.products)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        cache.clear()
+
+    def act(self, action, products=(), **fields):
+        data = {'action': action, 'index': 0,
+                '_selected_action': [product.pk for product in products],
+                **fields}
+        if not products:
+            data['select_across'] = 1
+            data['_selected_action'] = [self.products[0].pk]
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('admin:catalog_product_changelist'), data,
+                follow=True)
+
+    def prices(self):
+        return list(Product.objects.order_by('pk')
+                    .values_list('base_price', 'discount'))
+
+    def test_range(self):
+        for action, field, value in (
+                ('set_discount', 'discount', 100),
+                ('set_discount', 'discount', 'x'),
+                ('set_base_price', 'price', -1),
+                ('multiply_base_price', 'multiplier', '0'),
+                ('multiply_base_price', 'multiplier', '10.01')):
+            with self.subTest(action=action, value=value):
+                response = self.act(action, **{field: value})
+                self.assertContains(response, 'enter a number from')
+                self.assertEqual(self.prices(), [(100, 0)] * 3)
+        # bounds are allowed
+        self.act('multiply_base_price', multiplier='0.01')
+        self.assertEqual(self.prices(), [(1, 0)] * 3)
+        self.act('multiply_base_price', multiplier='10')
+        self.assertEqual(self.prices(), [(10, 0)] * 3)
+
+    def test_selection(self):
+        self.act('set_discount', self.products[:2], discount=15)
+        self.assertEqual(self.prices(), [(100, 15), (100, 15), (100, 0)])
+        self.act('clear_discount')
+        self.act('set_base_price', price=80)
+        self.act('multiply_base_price', self.products[1:],
+                 multiplier='1.25')
+        self.assertEqual(self.prices(), [(80, 0), (100, 0), (100, 0)])
+
+    def test_wrong_category_filter(self):
+        url = reverse('admin:catalog_product_changelist')
+        for query in ('category__id__exact=abc',
+                      'category__id__inhierarchy=abc'):
+            with self.subTest(query=query):
+                response = self.client.get(f'{url}?{query}')
+                # admin drops wrong lookups: redirect with ?e=1
+                self.assertRedirects(response, f'{url}?e=1',
+                                     fetch_redirect_response=False)
+
+    def test_updated_at_and_catalog_version(self):
+        Product.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        version = get_catalog_version()
+        response = self.act('set_discount', discount=10)
+        self.assertContains(response, 'Discount 10% set for 3 products')
+        self.assertFalse(Product.objects.filter(
+            updated_at__lt=timezone.now() - timedelta(hours=1)).exists())
+        self.assertNotEqual(get_catalog_version(), version)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class AdminSearchTest(TestCase):
+    """ Search of the product list: the best matches of the index first"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.dotted = Product.objects.create(
+            title='Amber lentil', slug='amber-lentil', base_price=10,
+            description='<p>Turquoise dots</p>')
+        cls.turquoise = Product.objects.create(
+            title='Turquoise disc', slug='turquoise-disc', base_price=20)
+        Product.objects.create(title='Red disc', slug='red-disc',
+                               base_price=10)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def search(self, **params):
+        response = self.client.get(
+            reverse('admin:catalog_product_changelist'), params)
+        return response, [product.pk for product
+                          in response.context['cl'].result_list]
+
+    def test_ranked(self):
+        _, found = self.search(q='turquoise')
+        self.assertEqual(found, [self.turquoise.pk, self.dotted.pk])
+        # sorted by title column
+        _, found = self.search(q='turquoise', o='2')
+        self.assertEqual(found, [self.dotted.pk, self.turquoise.pk])
+
+    def test_limit(self):
+        with mock.patch.object(ProductAdmin, 'search_results_limit', 1):
+            response, found = self.search(q='turquoise')
+        self.assertEqual(found, [self.turquoise.pk])
+        self.assertContains(response, 'Only 1 best matches are shown')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES)
+class InstrumentationTest(TestCase):
+    """ Server-Timing header and Prometheus metrics of requests"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beads = Category.objects.create(title='Beads', slug='beads')
+        cls.bead = Product.objects.create(
+            title='Bead', slug='bead', base_price=10)
+        cls.bead.category.add(cls.beads)
+
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+
+    def test_server_timing(self):
+        timing = self.client.get('/catalog/beads/')['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="queries: [1-9]')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        self.assertRegex(timing, r'total;dur=[\d.]+')
+        # full-page cache
+        self.assertIn('queries: 0', self.client.get(
+            '/catalog/beads/')['Server-Timing'])
+
+    @override_settings(SERVER_TIMING=False)
+    def test_server_timing_hidden(self):
+        remote = {'REMOTE_ADDR': '10.0.0.1'}
+        self.assertNotIn('Server-Timing',
+                         self.client.get('/catalog/beads/', **remote))
+        self.assertNotIn('Server-Timing', self.client.get(
+            '/catalog/beads/', HTTP_X_FORWARDED_FOR='10.0.0.1'))
+        self.client.force_login(User.objects.create_user(
+            'staff', password='password', is_staff=True))
+        self.assertIn('Server-Timing',
+                      self.client.get('/catalog/beads/', **remote))
+        with self.settings(SERVER_TIMING=True):
+            self.client.logout()
+            self.assertIn('Server-Timing',
+                          self.client.get('/catalog/beads/', **remote))
+
+    def test_duplicate_queries(self):
+        metrics = RequestMetrics()
+        with connection.execute_wrapper(metrics):
+            for pk in (self.bead.pk, self.bead.pk, 0):
+                Product.objects.filter(pk=pk).exists()
+        self.assertEqual((metrics.queries, metrics.duplicates), (3, 1))
+
+    def test_metrics(self):
+        for _ in range(2):
+            self.client.get('/catalog/beads/')
+        self.assertEqual(
+            self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code,
+            404)
+        response = self.client.get('/metrics/')
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        metrics = response.content.decode()
+        self.assertIn('volgabeads_request_duration_seconds_bucket'
+                      '{view="category",le="+Inf"} 2\n', metrics)
+        self.assertIn('volgabeads_db_queries_bucket'
+                      '{view="category",le="0"} 1\n', metrics)
+        self.assertIn('# TYPE volgabeads_template_duration_seconds '
+                      'histogram\n', metrics)
+        self.assertRegex(metrics, r'volgabeads_cache_hits_total'
+                                  r'\{view="category"\} [1-9]')
+        self.assertIn('volgabeads_duplicate_queries_total'
+                      '{view="category"} 0\n', metrics)
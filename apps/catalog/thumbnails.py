@@ -0,0 +1,212 @@
+"""
+Generation of thumbnails of product pictures out of web requests.
+Pictures are rendered by a pool of processes (image processing is CPU
+bound, one process per core), rendered thumbnails are uploaded
+to the thumbnail storage by a few threads: the number of concurrent
+uploads is limited independently of the processes.
+Responsive renditions and the placeholder of a picture (see images.py)
+are made by the same processes.
+Generated urls are written to manifests of products (Product.thumbnails)
+with the signature of aliases and renditions options, so a picture
+is stale when it was changed (queued by Product.save) or the options
+were changed.
+"""
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import get_thumbnailer
+from easy_thumbnails.storage import thumbnail_default_storage
+
+from apps.catalog.cache import invalidate_catalog
+from apps.catalog.images import (
+    RENDITION_FORMATS, describe_picture, open_picture, render_renditions,
+    rendition_formats, rendition_widths,
+)
+from apps.catalog.models import Product
+
+# manifest entry key: signature of options the files were made with
+SIGNATURE_KEY = 'options'
+
+
+def manifest_signature():
+    """ Signature of the current aliases and renditions options"""
+    options = (sorted(aliases.all().items()), rendition_widths(),
+               [(mime, RENDITION_FORMATS[mime])
+                for mime in rendition_formats()])
+    return hashlib.md5(repr(options).encode()).hexdigest()[:12]
+
+
+def stale_pictures(product, signature, force=False):
+    """ (field, picture name) of product pictures without
+    up to date thumbnails in manifest"""
+    stale = []
+    for field in Product.PICTURE_FIELDS:
+        picture = getattr(product, field)
+        if not picture:
+            continue
+        entry = product.thumbnails.get(field, {})
+        if (force or entry.get('name') != picture.name
+                or entry.get(SIGNATURE_KEY) != signature):
+            stale.append((field, picture.name))
+    return stale
+
+
+def render_picture(name):
+    """ Files of the picture: [(alias or (mime type, width), file name,
+    content)] and its size and placeholder for the manifest.
+    Runs in pool processes: storage reads and CPU only, no database"""
+    with default_storage.open(name) as source:
+        # picture is read once for all files
+        data = source.read()
+    thumbnailer = get_thumbnailer(ContentFile(data), relative_name=name)
+    files = []
+    for alias, options in aliases.all().items():
+        thumbnail = thumbnailer.generate_thumbnail(dict(options, ALIAS=alias))
+        files.append((alias, thumbnail.name, thumbnail.read()))
+    image = open_picture(data)
+    files += render_renditions(image, name)
+    return files, describe_picture(image)
+
+
+def manifest_entry(urls, description):
+    """ Manifest entry of the picture: {alias: url, 'srcset':
+    {mime type: [[width, url], ...]}, size and placeholder}"""
+    entry = dict(description, srcset={})
+    for key, url in urls.items():
+        if isinstance(key, tuple):
+            mime, width = key
+            entry['srcset'].setdefault(mime, []).append([width, url])
+        else:
+            entry[key] = url
+    return entry
+
+
+def upload_thumbnail(name, content):
+    """ Store thumbnail (replacing the old file of the same name)"""
+    if thumbnail_default_storage.exists(name):
+        thumbnail_default_storage.delete(name)
+    thumbnail_default_storage.save(name, ContentFile(content))
+    return thumbnail_default_storage.url(name)
+
+
+def _init_process():
+    # spawned (not forked) process has no apps loaded
+    django.setup()
+
+
+class ThumbnailGenerator:
+    """ Process pool rendering pictures and thread pool uploading
+    thumbnails, with statistics of the work done"""
+
+    def __init__(self, processes=None, uploads=4):
+        # processes don't use the database: forked ones never touch
+        # (and never close) the inherited connections of the parent
+        self.processes = ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_process)
+        self.uploads = ThreadPoolExecutor(max_workers=uploads)
+        self.started = time.monotonic()
+        self.pictures = 0
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+
+    def close(self):
+        self.processes.shutdown()
+        self.uploads.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def generate(self, jobs):
+        """ Thumbnails of (product pk, field, picture name) jobs.
+        Returns {(pk, field, name): manifest entry or exception}"""
+        # a picture shared by products is rendered once
+        rendering = {}
+        for job in jobs:
+            if job[2] not in rendering:
+                rendering[job[2]] = self.processes.submit(
+                    render_picture, job[2])
+        uploading = {}
+        for name, future in rendering.items():
+            try:
+                files, description = future.result()
+            except Exception as error:
+                uploading[name] = error
+                continue
+            # uploads of this picture go while next ones are rendered
+            uploading[name] = (description, [
+                (key, self.uploads.submit(upload_thumbnail, *file))
+                for key, *file in files
+            ])
+            self.files += len(files)
+            self.bytes += sum(len(content) for _, _, content in files)
+        entries = {}
+        for name, uploads in uploading.items():
+            if isinstance(uploads, Exception):
+                entries[name] = uploads
+                continue
+            description, futures = uploads
+            try:
+                entries[name] = manifest_entry(
+                    {key: future.result() for key, future in futures},
+                    description)
+            except Exception as error:
+                entries[name] = error
+        results = {job: entries[job[2]] for job in jobs}
+        for result in results.values():
+            if isinstance(result, Exception):
+                self.failed += 1
+            else:
+                self.pictures += 1
+        return results
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        return (
+            f'Pictures: {self.pictures}, files: {self.files} '
+            f'({self.bytes / 2 ** 20:.1f} MiB), failed: {self.failed} '
+            f'in {elapsed:.1f} s: '
+            f'{self.pictures / max(elapsed, 1e-6):.1f} pictures/s'
+        )
+
+
+def save_manifests(results, signature):
+    """ Put urls of generated thumbnails to manifests of products.
+    Picture changed meanwhile keeps its entry (it is queued again).
+    Returns number of updated products"""
+    generated = {}
+    for (pk, field, name), entry in results.items():
+        if not isinstance(entry, Exception):
+            generated.setdefault(pk, []).append((field, name, entry))
+    if not generated:
+        return 0
+    with transaction.atomic():
+        products = Product.objects.select_for_update().filter(
+            pk__in=generated).only('thumbnails', *Product.PICTURE_FIELDS)
+        changed = []
+        for product in products:
+            manifest = dict(product.thumbnails)
+            for field, name, entry in generated[product.pk]:
+                if getattr(product, field).name == name:
+                    manifest[field] = dict(
+                        entry, name=name, **{SIGNATURE_KEY: signature})
+            if manifest != product.thumbnails:
+                product.thumbnails = manifest
+                changed.append(product)
+        for product in changed:
+            # new updated_at: cached cards get the thumbnails
+            Product.objects.filter(pk=product.pk).update(
+                thumbnails=product.thumbnails)
+        if changed:
+            invalidate_catalog()
+    return len(changed)
@@ -1,8 +1,11 @@
 from .category import CategoryView
 from .product import ProductView
+from .search import SearchView, search_suggest
 
 
 __all__ = (
     'CategoryView',
-    'ProductView'
+    'ProductView',
+    'SearchView',
+    'search_suggest',
 )
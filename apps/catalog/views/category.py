@@ -1,20 +1,38 @@
 """
 Provides functionality for render list of products page.
 """
-import random
-from django.db.models import Q
-from django.shortcuts import get_object_or_404
+from django.http import Http404
+from django.urls import reverse
 from django.views.generic import ListView
 
-from apps.catalog.models import Product, Category
+from apps.catalog.facets import (
+    filter_products, get_facet_summary, parse_selection, selection_query,
+)
+from apps.catalog.models import Product
+from apps.catalog.navigation import get_navigation
+from apps.catalog.pagination import paginate_after
+from apps.catalog.promotions import get_promo_items, get_promo_seed
 from mixins import CartContentMixin
 
 
 class CategoryView(CartContentMixin, ListView):
     """View class for displaying list or products."""
     is_main_page = False
+    # render only product cards of the page (infinite scroll fragment)
+    cards_only = False
+    # next pages are selected by 'after' cursor (keyset pagination)
+    paginate_by = 60
+
+    def get_demanded_category(self):
+        """ Category from URL taken from cached navigation (no query)"""
+        category = get_navigation().get(self.kwargs['slug'])
+        if category is None:
+            raise Http404('No category found')
+        return category
 
     def get_template_names(self):
+        if self.cards_only:
+            return ['_product_cards.html']
         # Use special template for 'tutorials' category
         if self.kwargs.get('slug') == 'tutorials':
             return ['tutorial_list.html']
@@ -23,45 +41,80 @@ class CategoryView(CartContentMixin, ListView):
     def get_queryset(self):
         # for main page: all products in_stock and visible_after_sale
         # except 'tutorials'
-        queryset = (Product.objects
-                    .exclude(category__slug='tutorials')
-                    .filter(Q(in_stock=True) | Q(show_after_sale=True))
-                    )
+        # denormalized flags: no join to categories, index-only filter
+        queryset = Product.objects.filter(is_tutorial=False, is_visible=True)
         # for non-main page make queryset depending on category
         if not self.is_main_page and (slug := self.kwargs['slug']):
             # 'sale' is virtual category - filtering products by discount
             if slug == 'sale':
                 queryset = (Product.objects
                             .filter(discount__gt=0, in_stock=True)
-                            .order_by('-discount')
+                            .with_price()
+                            .order_by('-discount', 'current_price')
                             )
             # 'tutorials' excluded from main queryset, so new search needed
             elif slug == 'tutorials':
-                queryset = Product.objects.filter(category__slug='tutorials')
-            # for any other category simply adding filter by category
+                queryset = Product.objects.filter(is_tutorial=True)
+            # any other category: products of the category
+            # and all its subcategories
             else:
-                category = get_object_or_404(Category, slug=slug)
-                queryset = queryset.filter(category=category)
-        return queryset
+                category = self.get_demanded_category()
+                queryset = queryset.in_category(category)
+        # listing without facets: source of facet counts
+        self.listing_queryset = queryset
+        if not self.has_facets():
+            return queryset
+        return filter_products(queryset, self.get_facet_selection())
+
+    def get_listing_name(self):
+        return 'main' if self.is_main_page else self.kwargs['slug']
+
+    def has_facets(self):
+        """ Tutorials have no sizes and holes to filter by"""
+        return self.is_main_page or self.kwargs.get('slug') != 'tutorials'
+
+    def get_facet_selection(self):
+        if not hasattr(self, 'facet_selection'):
+            self.facet_selection = parse_selection(self.request.GET)
+        return self.facet_selection
+
+    def paginate_queryset(self, queryset, page_size):
+        """ Keyset pagination instead of OFFSET-based one of ListView"""
+        page = paginate_after(
+            queryset, page_size, self.request.GET.get('after'))
+        return None, page, page.object_list, page.has_next()
 
     def get_context_data(self, **kwargs):
         # Add context variables
         context = super().get_context_data(**kwargs)
+
+        # urls of the full listing page and of its cards-only fragment
+        slug = None if self.is_main_page else self.kwargs.get('slug')
+        if slug:
+            context['list_path'] = reverse('category', args=[slug])
+            context['cards_path'] = reverse('category-cards', args=[slug])
+        else:
+            context['list_path'] = reverse('main-page')
+            context['cards_path'] = reverse('main-page-cards')
+        context['card_template'] = (
+            '_tutorial_card.html' if slug == 'tutorials' else '_prod_card.html')
+        # normalized query of selected facets for links of next pages
+        context['facet_query'] = (
+            selection_query(self.get_facet_selection())
+            if self.has_facets() else '')
+        # fragment for infinite scroll needs no menus and promotions
+        if self.cards_only:
+            return context
+
         # navigation menu - top level categories
         # root non-empty visible categories join with 'virtual' sale category
         # except categories shown in header
-        roots = Category.objects.filter(
-            parent=None, visibility=True, show_at_header=False
-        ).filter(Q(products__in_stock=True) | Q(products__show_after_sale=True))
-        if Product.objects.filter(in_stock=True, discount__gt=0).exists():
-            # don't change .filter to .get - it doesn't work with .distinct()
-            sale = Category.objects.filter(slug='sale', visibility=True)
-            roots = roots | sale
-        context['roots'] = roots.distinct().order_by('view_priority')
+        navigation = get_navigation()
+        context['roots'] = navigation.roots()
 
         # constructing text for html <head><title> and for category naming
         if not self.is_main_page and (slug := self.kwargs['slug']):
-            demanded_category = Category.objects.get(slug=slug)
+            demanded_category = self.get_demanded_category()
             head_title = demanded_category.title
             context['head_tag_title'] = (
                 f'Olga Vilnova Lampwork Beads. {head_title}.'
@@ -73,39 +126,24 @@ class CategoryView(CartContentMixin, ListView):
                 context['category_text'] = f'Beads in category {demanded_category}'
 
             # determine show or not navigation submenu and active elements
-            root = (demanded_category.parent if demanded_category.parent
-                    else demanded_category)
+            root = (navigation.get_parent(demanded_category)
+                    or demanded_category)
             context['active_branch'] = demanded_category
             context['active_root'] = root
-            context['branches'] = (
-                Category.objects
-                .filter(parent=root, visibility=True, show_at_header=False)
-                .filter(Q(products__in_stock=True) | Q(products__show_after_sale=True))
-                .distinct().order_by('view_priority')
-            )
+            context['branches'] = navigation.branches(root)
 
         # in other cases - showing main page and base catalog
         else:
             context['category_text'] = 'All beads'
             context['head_tag_title'] = 'Olga Vilnova Lampwork Beads.'
 
-        # collects 8 items to promo section: firsts 'promoted' items,
-        # if missing, trying to get 16 max-priced items and take randoms
-        # to combine with promoted. get no errors if not enough items.
-        # shuffle result.
-        promo_items = Product.objects.filter(
-            promoted=True, in_stock=True, reserved=False)
-        number_of_promo_items = promo_items.count()
-        if number_of_promo_items >= 8:
-            promo_items = random.sample(list(promo_items), 8)
-        else:
-            additional_promo_items = Product.objects.filter(
-                promoted=False, in_stock=True, reserved=False
-            ).order_by('-base_price')[:16]
-            additional_promo_items = random.sample(
-                list(additional_promo_items),
-                min(len(additional_promo_items), (8-number_of_promo_items)))
-            promo_items = list(promo_items) + additional_promo_items
-        random.shuffle(promo_items)
-        context['promotions'] = promo_items
+        # facets with numbers of products (cached summary of the listing)
+        if self.has_facets():
+            summary = get_facet_summary(
+                self.get_listing_name(), self.listing_queryset)
+            context['facets'] = summary.facets(self.get_facet_selection())
+            context['facet_total'] = summary.total(self.get_facet_selection())
+
+        # 8 random items from cached pool of promoted and top-priced ones
+        context['promotions'] = get_promo_items(get_promo_seed())
         return context
@@ -1,6 +1,7 @@
 from django.views.generic import DetailView
 
-from apps.catalog.models import Product, Category
+from apps.catalog.models import Product
+from apps.catalog.navigation import get_navigation
 
 from mixins import CartContentMixin
 
@@ -9,22 +10,16 @@ class ProductView(CartContentMixin, DetailView):
     model = Product
 
     def get_template_names(self):
-        product = self.get_object()
-        if product.category.filter(slug='tutorials').exists():
+        # object is already fetched by DetailView.get()
+        if self.object.is_tutorial:
             return ['tutorial.html']
         return ['product.html']
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        head_title = Product.objects.get(slug=self.kwargs["slug"]).title
+        head_title = self.object.title
         context['head_tag_title'] = f'Olga Vilnova Lampwork. {head_title}.'
 
-        roots = Category.objects.filter(
-            parent=None, products__isnull=False, visibility=True
-        )
-        if Product.objects.filter(in_stock=True, discount__gt=0).exists():
-            # don't change .filter to .get - it doesn't work with .distinct()
-            sale = Category.objects.filter(slug='sale', visibility=True)
-            roots = roots | sale
-        context['roots'] = roots.distinct().order_by('view_priority')
+        # root visible categories with products and 'virtual' sale category
+        context['roots'] = get_navigation().product_page_roots()
         return context
@@ -0,0 +1,75 @@
+"""
+Storefront search of products (see apps/catalog/search.py for the index).
+"""
+from urllib.parse import urlencode
+
+from django.db.models import Q
+from django.http import JsonResponse
+from django.urls import reverse
+from django.views.generic import ListView
+
+from apps.catalog.models import Product
+from apps.catalog.navigation import get_navigation
+from apps.catalog.search import search_product_ids
+from mixins import CartContentMixin
+
+# number of the best matches shown (no pagination of ranked results)
+SEARCH_RESULTS_LIMIT = 120
+SUGGESTIONS_LIMIT = 8
+# matches are ranked by the index, hidden products are dropped by DB:
+# candidates are checked by chunks in order of rank until limit is reached
+SEARCH_CANDIDATES_LIMIT = 5000
+CANDIDATES_CHUNK_SIZE = 500
+# products found by search: visible beads and tutorials
+SEARCHABLE = Q(is_visible=True) | Q(is_tutorial=True)
+
+
+def find_products(query, limit, prefix=True):
+    """ Searchable products matching the query in order of rank
+    (usually one query besides the search itself)"""
+    product_ids = search_product_ids(query, SEARCH_CANDIDATES_LIMIT, prefix)
+    found = []
+    for start in range(0, len(product_ids), CANDIDATES_CHUNK_SIZE):
+        chunk = product_ids[start:start + CANDIDATES_CHUNK_SIZE]
+        products = {
+            product.pk: product
+            for product in Product.objects.filter(SEARCHABLE, pk__in=chunk)
+        }
+        found.extend(products[pk] for pk in chunk if pk in products)
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+
+class SearchView(CartContentMixin, ListView):
+    """ Product cards found by 'q' parameter, the best matches first"""
+    template_name = 'search.html'
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    def get_queryset(self):
+        # whole words only: full page of results is not a type-ahead
+        return find_products(self.get_query(), SEARCH_RESULTS_LIMIT,
+                             prefix=False)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.get_query()
+        context['query'] = query
+        context['list_path'] = (
+            f"{reverse('search')}?{urlencode({'q': query})}")
+        context['head_tag_title'] = (
+            f'Olga Vilnova Lampwork Beads. Search: {query}.')
+        context['roots'] = get_navigation().roots()
+        return context
+
+
+def search_suggest(request):
+    """ Type-ahead: titles and urls of the best matches (JSON)"""
+    products = find_products(
+        request.GET.get('q', ''), SUGGESTIONS_LIMIT, prefix=True)
+    return JsonResponse({'results': [
+        {'title': product.title, 'url': product.get_absolute_url()}
+        for product in products
+    ]})
@@ -0,0 +1,287 @@
+"""
+Per-request performance instrumentation, cheap enough to be always on.
+InstrumentationMiddleware measures every request:
+- number and time of database queries (execute_wrapper of every
+  connection) and duplicate queries: the same SQL with the same
+  parameters, usually a missed select_related or a query in a loop;
+- time of template rendering: templates rendered by the
+  InstrumentedTemplates backend (TEMPLATES setting), nested renders
+  are not counted twice. Lazy querysets evaluated by templates are
+  counted in both template and database time;
+- hits and misses of get() of every cache of CACHES (full pages,
+  catalog snapshots, {% cache %} fragments of cards).
+The numbers are sent to the browser in the Server-Timing header (see
+dev tools of the browser): to everybody with SERVER_TIMING setting
+(DEBUG by default), else to staff and METRICS_ALLOWED_IPS only - the
+numbers tell how the site works inside. They are also aggregated
+per view name into histograms of this process, exported in Prometheus
+text format by metrics_view for local scrapers (METRICS_ALLOWED_IPS).
+Every process (worker) has its own metrics: scrape every worker and
+sum them up in queries.
+"""
+import bisect
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.template.backends.django import DjangoTemplates, Template
+
+METRICS_PREFIX = 'volgabeads'
+# upper bounds of histogram buckets: seconds and numbers of queries
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# metrics of the request being processed (None out of requests)
+_current = ContextVar('request_metrics', default=None)
+_MISSING = object()
+
+
+class RequestMetrics:
+    """ Numbers of one request"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.duplicates = 0
+        self.template_time = 0.0
+        self.rendering = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._statements = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        """ execute_wrapper of database connections"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            if not many:
+                statement = (sql, repr(params))
+                if statement in self._statements:
+                    self.duplicates += 1
+                else:
+                    self._statements.add(statement)
+
+    def server_timing(self, total):
+        """ Value of Server-Timing header (durations in ms)"""
+        return (
+            f'db;dur={self.db_time * 1000:.1f};'
+            f'desc="queries: {self.queries}, '
+            f'duplicates: {self.duplicates}", '
+            f'tpl;dur={self.template_time * 1000:.1f}, '
+            f'cache;desc="hits: {self.cache_hits}, '
+            f'misses: {self.cache_misses}", '
+            f'total;dur={total * 1000:.1f}'
+        )
+
+
+class Histogram:
+    """ Numbers of observed values by buckets (not cumulative),
+    the last one is +Inf"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """ Histograms and counters of this process by view name"""
+    # name, help, buckets, value of RequestMetrics and request time
+    HISTOGRAMS = (
+        ('request_duration_seconds', 'Time of request processing',
+         TIME_BUCKETS, lambda metrics, total: total),
+        ('db_queries', 'Database queries per request',
+         QUERY_BUCKETS, lambda metrics, total: metrics.queries),
+        ('db_duration_seconds', 'Time of database queries per request',
+         TIME_BUCKETS, lambda metrics, total: metrics.db_time),
+        ('template_duration_seconds', 'Time of template rendering '
+         'per request', TIME_BUCKETS,
+         lambda metrics, total: metrics.template_time),
+    )
+    COUNTERS = (
+        ('duplicate_queries_total', 'Repeated queries (the same SQL '
+         'and parameters) in a request', 'duplicates'),
+        ('cache_hits_total', 'Hits of cache get()', 'cache_hits'),
+        ('cache_misses_total', 'Misses of cache get()', 'cache_misses'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {view name: ([Histogram of HISTOGRAMS], [value of COUNTERS])}
+        self._views = {}
+
+    def observe(self, view, metrics, total):
+        with self._lock:
+            if view not in self._views:
+                self._views[view] = (
+                    [Histogram(buckets) for _, _, buckets, _
+                     in self.HISTOGRAMS],
+                    [0] * len(self.COUNTERS),
+                )
+            histograms, counters = self._views[view]
+            for histogram, (_, _, _, value) in zip(histograms,
+                                                   self.HISTOGRAMS):
+                histogram.observe(value(metrics, total))
+            for i, (_, _, attribute) in enumerate(self.COUNTERS):
+                counters[i] += getattr(metrics, attribute)
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def export(self):
+        """ All metrics in Prometheus text format"""
+        with self._lock:
+            views = sorted(
+                (view, [(list(histogram.counts), histogram.sum)
+                        for histogram in histograms], list(counters))
+                for view, (histograms, counters) in self._views.items()
+            )
+        lines = []
+        for i, (name, help_text, buckets, _) in enumerate(self.HISTOGRAMS):
+            name = f'{METRICS_PREFIX}_{name}'
+            lines += [f'# HELP {name} {help_text}',
+                      f'# TYPE {name} histogram']
+            for view, histograms, _ in views:
+                counts, total = histograms[i]
+                label = f'view="{_escape_label(view)}"'
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf', ), counts):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines += [f'{name}_sum{{{label}}} {total}',
+                          f'{name}_count{{{label}}} {cumulative}']
+        for i, (name, help_text, _) in enumerate(self.COUNTERS):
+            name = f'{METRICS_PREFIX}_{name}'
+            lines += [f'# HELP {name} {help_text}',
+                      f'# TYPE {name} counter']
+            lines += [f'{name}{{view="{_escape_label(view)}"}} {counters[i]}'
+                      for view, _, counters in views]
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _counting_get(get):
+    """ get() of a cache counting hits and misses of the request"""
+
+    def counting_get(key, default=None, version=None):
+        value = get(key, _MISSING, version=version)
+        metrics = _current.get()
+        if metrics is not None:
+            if value is _MISSING:
+                metrics.cache_misses += 1
+            else:
+                metrics.cache_hits += 1
+        return default if value is _MISSING else value
+
+    return counting_get
+
+
+def _instrument_caches():
+    """ Count get() of every cache. Cache objects are made per thread
+    (and again when CACHES is changed): each is wrapped once"""
+    for alias in settings.CACHES:
+        cache = caches[alias]
+        if 'get' not in vars(cache):
+            # get_many() and get_or_set() of BaseCache use it too
+            cache.get = _counting_get(cache.get)
+
+
+class InstrumentationMiddleware:
+    """ Measures requests (the first middleware: the time of all
+    others is included), see the module docstring"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        reset_token = _current.set(metrics)
+        _instrument_caches()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(reset_token)
+        total = time.perf_counter() - started
+        match = request.resolver_match
+        registry.observe(match.view_name if match else '<unresolved>',
+                         metrics, total)
+        # no user: answered before AuthenticationMiddleware
+        user = getattr(request, 'user', None)
+        if (getattr(settings, 'SERVER_TIMING', settings.DEBUG)
+                or _is_local(request) or (user and user.is_staff)):
+            response['Server-Timing'] = metrics.server_timing(total)
+        return response
+
+
+class InstrumentedTemplate(Template):
+    """ Template measuring the time of its rendering"""
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None or metrics.rendering:
+            return super().render(context, request)
+        metrics.rendering = True
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - started
+            metrics.rendering = False
+
+
+class InstrumentedTemplates(DjangoTemplates):
+    """ Django templates backend with InstrumentedTemplate"""
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(
+            self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(
+            super().get_template(template_name).template, self)
+
+
+def _is_local(request):
+    """ Request from METRICS_ALLOWED_IPS, not through a proxy: a proxy
+    on the same host would make every visitor local"""
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS',
+                          ('127.0.0.1', '::1'))
+    return (request.META.get('REMOTE_ADDR') in allowed_ips
+            and 'HTTP_X_FORWARDED_FOR' not in request.META
+            and 'HTTP_X_REAL_IP' not in request.META)
+
+
+def metrics_view(request):
+    """ Metrics of this process in Prometheus text format, for scrapers
+    on METRICS_ALLOWED_IPS only"""
+    if not _is_local(request):
+        raise Http404
+    return HttpResponse(registry.export(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
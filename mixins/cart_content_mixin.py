@@ -1,5 +1,4 @@
-from apps.cart.models import CartItem
-from utils import get_or_create_cart_for_session
+from utils import get_cart_content
 
 
 class CartContentMixin:
@@ -7,9 +6,14 @@ class CartContentMixin:
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        cart = get_or_create_cart_for_session(self.request.session)
+        # read-only pages never write session or cart in DB
+        # (cart is shared with ETag of the page, see page_cache.py)
+        cart, cart_product_ids = get_cart_content(self.request)
 
         context['cart'] = cart
-        cart_content = list(item.product for item in CartItem.objects.filter(cart=cart))
-        context['cart_content'] = cart_content
+        # set of products pk-s (one query) for O(1) checks in product cards:
+        # {% if product.pk in cart_product_ids %}
+        context['cart_product_ids'] = cart_product_ids
+        # kept for the cart badge in header (number of items)
+        context['cart_content'] = cart_product_ids
         return context
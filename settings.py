@@ -2,6 +2,7 @@
 Settings for VOlgaBeads
 """
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -32,8 +33,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # the first one: measures all the others too
+    'instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'apps.cart.middleware.CartCookieMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -45,7 +49,8 @@ ROOT_URLCONF = 'urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates measuring time of rendering (instrumentation.py)
+        'BACKEND': 'instrumentation.InstrumentedTemplates',
         'DIRS': ['templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -86,6 +91,26 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 STATIC_URL = 'static/'
 
+# Cache shared by all worker processes of the host: catalog version
+# and snapshots (apps/catalog/cache.py), product card fragments.
+# For several hosts override it in prod_settings (Redis, Memcached).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'volgabeads_cache')),
+    },
+}
+
+# Product search engine (apps/catalog/search.py): 'postgres' - native
+# full-text search, 'python' - in-memory index, 'auto' - by database vendor
+CATALOG_SEARCH_ENGINE = 'auto'
+
+# Change it to drop ETags and full-page cache of catalog pages
+# after changes of templates (apps/catalog/page_cache.py)
+PAGE_CACHE_REVISION = '1'
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -102,8 +127,11 @@ SESSION_COOKIE_AGE = 86400 * 60  # 86400 seconds per day multiply 60 days
 
 
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
-# auto-renew session expire_time for active client for not deleting cart
-SESSION_SAVE_EVERY_REQUEST = True
+# sessions are for admins only: visitors' carts are kept by cart cookie
+# (apps/cart/middleware.py), renewed when half of its age is left -
+# no session writes on every request
+SESSION_SAVE_EVERY_REQUEST = False
+CART_COOKIE_AGE = SESSION_COOKIE_AGE
 
 # Aliases preset for thumbnails (origin bead's photo size is always 750x750)
 THUMBNAIL_ALIASES = {
@@ -112,10 +140,25 @@ THUMBNAIL_ALIASES = {
         'small': {'size': (70, 70)},
     },
 }
+# widths of WebP/AVIF renditions of pictures for srcset (px):
+# cards 280px at 1x and 2x, product page image
+PICTURE_WIDTHS = (280, 560, 750)
 
 # CSS margin-left for displaying children nodes in model tree (px)
 MPTT_ADMIN_LEVEL_INDENT = 20
 
+# promotions section: 'request' - new random items for every request,
+# 'window' - the same items during PROMO_WINDOW seconds (cacheable page)
+PROMO_SAMPLING = 'request'
+PROMO_WINDOW = 300
+
+# per-request instrumentation (instrumentation.py): Server-Timing header
+# with queries, DB/template time and cache hits for everybody (else for
+# staff and these addresses only); metrics for Prometheus at /metrics/
+# for scrapers from these addresses only
+SERVER_TIMING = DEBUG
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
 # from local/production_setting imports
 # ALLOWED_HOSTS
 # CSRF_TRUSTED_ORIGINS
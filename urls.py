@@ -8,36 +8,63 @@ from django.conf.urls.static import static
 from django.views.generic import TemplateView
 from django.urls import path
 
-from apps.catalog.views import CategoryView, ProductView
+from apps.catalog.page_cache import catalog_page
+from apps.catalog.views import (
+    CategoryView, ProductView,
+    SearchView, search_suggest,
+)
 from apps.cart.views import (
     CartView,
     add_item, remove_item,
-    make_order_from_cart,
+    cart_add, cart_remove, cart_state,
+    make_order_from_cart, personal_fragment,
 )
+from instrumentation import metrics_view
 
 urlpatterns = [
     # custom admin panel URL
     path('admin/', admin.site.urls),
     # general views
-    path('', CategoryView.as_view(is_main_page=True), name='main-page'),
-    path('catalog/<str:slug>/', CategoryView.as_view(), name='category'),
-    path('product/<str:slug>/', ProductView.as_view(), name='product'),
+    path('', catalog_page(CategoryView.as_view(is_main_page=True)),
+         name='main-page'),
+    path('catalog/<str:slug>/', catalog_page(CategoryView.as_view()),
+         name='category'),
+    # next pages of product cards for infinite scroll (html fragments)
+    path('cards/', CategoryView.as_view(is_main_page=True, cards_only=True),
+         name='main-page-cards'),
+    path('catalog/<str:slug>/cards/', CategoryView.as_view(cards_only=True),
+         name='category-cards'),
+    path('product/<str:slug>/', catalog_page(ProductView.as_view()),
+         name='product'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('search/suggest/', search_suggest, name='search-suggest'),
     path('cart/', CartView.as_view(), name='cart'),
     # static pages
     path('about/',
-         TemplateView.as_view(template_name='static_pages/about.html'),
+         catalog_page(TemplateView.as_view(
+             template_name='static_pages/about.html'), personal=False),
          name='about'),
     path('faq/',
-         TemplateView.as_view(template_name='static_pages/faq.html'),
+         catalog_page(TemplateView.as_view(
+             template_name='static_pages/faq.html'), personal=False),
          name='faq'),
     path('policies/',
-         TemplateView.as_view(template_name='static_pages/policies.html'),
+         catalog_page(TemplateView.as_view(
+             template_name='static_pages/policies.html'), personal=False),
          name='policies'),
 
     # non-public (API-like) for internal use URLs
     path('remove_item/', remove_item, name='remove-item'),
     path('add_item/', add_item, name='add-item'),
     path('make_order/', make_order_from_cart, name='make-order-from-cart'),
+    # JSON API of cart (form endpoints above are fallbacks without JS)
+    path('api/cart/', cart_state, name='api-cart'),
+    path('api/cart/add/', cart_add, name='api-cart-add'),
+    path('api/cart/remove/', cart_remove, name='api-cart-remove'),
+    # personal data for public (cached) pages: cart badge, CSRF token
+    path('personal/', personal_fragment, name='personal-fragment'),
+    # Prometheus metrics of the process (local scrapers only)
+    path('metrics/', metrics_view, name='metrics'),
 
 ]
 
@@ -3,66 +3,296 @@ This module contains a collection of utility functions
  for managing order and cart statuses and behavior.
  These functions are designed to be used both by users and administrators.
 """
+import random
+import time
+from collections import defaultdict
+
+from django.conf import settings
 from django.contrib.sessions.models import Session
-from apps.cart.models import Cart
-
-
-def get_or_create_cart_for_session(session_store_obj):
-    """ Get or create a Cart instance associated with a session."""
-    # for a saved session the key is available
-    session_key = session_store_obj.session_key
-    if not session_key:
-        # for a new session (not stored in DB) the key is missing.
-        # it becomes available after save()
-        session_store_obj.save()
-        session_key = session_store_obj.session_key
-    session = Session.objects.get(session_key=session_key)
-
-    # attempt to getting a Cart for current session with status 'NEW'
-    cart = Cart.objects.filter(session=session, status='NEW').first()
-    # if no Cart was found, create a new one
-    if not cart:
-        cart = Cart.objects.create(session=session, status='NEW')
+from django.db import OperationalError, connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from apps.cart.models import Cart, CartItem, Order, OrderItem
+from apps.catalog.models import Product
+from apps.catalog.cache import invalidate_catalog
+
+
+def get_cart(request):
+    """ Get a Cart instance of the visitor (by token from cart cookie,
+    see apps/cart/middleware.py) without any writes.
+    For visitors without cart returns empty 'virtual' (unsaved) Cart."""
+    cart = None
+    if request.cart_token:
+        cart = Cart.objects.filter(
+            token=request.cart_token, status='NEW').first()
+    elif settings.SESSION_COOKIE_NAME in request.COOKIES:
+        # cart made before tokens: its token is the session key
+        # (see migrate_cart_tokens), the cart cookie is set from now.
+        # Only a live session of the visitor: the unsigned cookie
+        # must not open carts by their tokens
+        sessions = Session.objects.filter(
+            session_key=OuterRef('token'), expire_date__gt=timezone.now())
+        cart = Cart.objects.filter(
+            Exists(sessions),
+            token=request.COOKIES[settings.SESSION_COOKIE_NAME],
+            status='NEW').first()
+        if cart:
+            request.cart_token = cart.token
+            request.cart_token_changed = True
+            # activity mark of the new cookie (see purge_stale_carts)
+            Cart.objects.filter(pk=cart.pk).update(date_updated=timezone.now())
+    # virtual cart: never saved, has no pk and no items
+    return cart or Cart(status='NEW', token=None)
+
+
+def get_cart_content(request):
+    """ Cart of the visitor and set of pk-s of its products
+    (2 queries at most), kept in request: the same for page context
+    and its ETag"""
+    if not hasattr(request, 'cart_content'):
+        cart = get_cart(request)
+        product_ids = set()
+        if cart.pk:
+            product_ids = set(
+                CartItem.objects.filter(cart=cart)
+                .values_list('product_id', flat=True)
+            )
+        request.cart_content = (cart, product_ids)
+    return request.cart_content
+
+
+def get_or_create_cart(request):
+    """ Get or create a Cart instance of the visitor, a new cart
+    is given to the visitor by cookie. Use it only when cart must exist
+    in DB (adding items)."""
+    cart = get_cart(request)
+    if cart.pk is None:
+        cart = Cart.objects.create()
+        request.cart_token = cart.token
+        request.cart_token_changed = True
     return cart
 
 
-def set_reserve_for_order_items(order):
-    """ Set the 'reserved' status for products in the given Order."""
-    order_content = order.items.all()
-    for item in order_content:
-        item.product.reserved = True
-        item.product.save()
-    order.status = 'RESERVED'
-    order.save()
+def add_to_cart(cart, product):
+    """ Put product to cart with its current price (one statement,
+    nothing is changed if the product is already in the cart)"""
+    CartItem.objects.bulk_create(
+        [CartItem(cart=cart, product=product, price=product.price)],
+        ignore_conflicts=True,
+    )
+
+
+def get_cart_state(cart):
+    """ Products pk-s of cart, their number and subtotal of available
+    ones (the same as on cart page) - one query"""
+    product_ids, subtotal = [], 0
+    if cart.pk:
+        items = CartItem.objects.filter(cart=cart).values_list(
+            'product_id', 'product__base_price', 'product__discount',
+            'product__in_stock', 'product__reserved',
+        ).order_by('pk')
+        for product_id, base_price, discount, in_stock, reserved in items:
+            product_ids.append(product_id)
+            if in_stock and not reserved:
+                # the same integer arithmetic as Product.price
+                subtotal += base_price * (100 - discount) // 100
+    return {
+        'product_ids': product_ids,
+        'count': len(product_ids),
+        'subtotal': subtotal,
+    }
+
+
+# how products of an Order change with the new status of the Order
+ORDER_STATUS_PRODUCT_FIELDS = {
+    'RESERVED': {'reserved': True},
+    'WIP': {'reserved': True},
+    'CANCELED': {'reserved': False},
+    'COMPLETED': {'reserved': False, 'in_stock': False},
+}
+# statuses of Orders holding their products (products are reserved)
+HOLDING_ORDER_STATUSES = ('RESERVED', 'WIP')
+
+
+def _plan_orders_status(status, order_statuses, order_products, products):
+    """ Orders refused to take the status and products to be changed.
+    Orders not holding their products (new, canceled, completed) can take
+    them only if they are still in stock and not reserved by other orders"""
+    refused, changed = set(), set()
+    for order_id, current in order_statuses.items():
+        if current in HOLDING_ORDER_STATUSES:
+            # order keeps or releases its own products
+            changed.update(order_products[order_id])
+        elif status != 'CANCELED' and status != current:
+            is_free = all(
+                # tutorials are never reserved and can be sold many times
+                products[pk]['is_tutorial'] or (
+                    products[pk]['in_stock'] and not products[pk]['reserved']
+                    and pk not in changed)
+                for pk in order_products[order_id]
+            )
+            if is_free:
+                changed.update(order_products[order_id])
+            else:
+                refused.add(order_id)
+        # order without products is canceled (or sold again): no changes
+    return refused, changed
+
+
+def change_orders_status(orders, status):
+    """ Set the status for Orders (an Order instance or a queryset of Orders)
+    and change all their products with one UPDATE per table.
+    Rows are locked, so concurrent checkouts and admin actions
+    can't reserve or sell the same products twice.
+    Returns ids of refused Orders: their products were sold
+    or reserved by other orders meanwhile."""
+    if isinstance(orders, Order):
+        orders_filter = [orders.pk]
+    else:
+        orders_filter = orders.order_by().values('pk')
+    product_fields = ORDER_STATUS_PRODUCT_FIELDS[status]
+
+    with transaction.atomic():
+        # lock orders and then their products (always in the same order)
+        order_statuses = dict(
+            Order.objects.select_for_update()
+            .filter(pk__in=orders_filter).order_by('pk')
+            .values_list('pk', 'status')
+        )
+        products = {
+            product['pk']: product for product in
+            Product.objects.select_for_update()
+            .filter(pk__in=OrderItem.objects
+                    .filter(order__in=order_statuses).values('product_id'))
+            .order_by('pk')
+            .values('pk', 'in_stock', 'reserved', 'is_tutorial')
+        }
+        order_products = defaultdict(list)
+        for order_id, product_id in OrderItem.objects.filter(
+                order__in=order_statuses).values_list('order_id', 'product_id'):
+            order_products[order_id].append(product_id)
+
+        refused, product_ids = _plan_orders_status(
+            status, order_statuses, order_products, products)
+        # tutorials are never reserved: see ProductQuerySet.update()
+        Product.objects.filter(pk__in=product_ids).update(**product_fields)
+        # .update() skips auto_now, so 'updated' is set explicitly
+        Order.objects.filter(
+            pk__in=[pk for pk in order_statuses if pk not in refused],
+        ).update(status=status, updated=timezone.now())
+
+    if isinstance(orders, Order) and orders.pk not in refused:
+        orders.status = status
+    # .update() sends no signals: drop cached catalog data explicitly
+    invalidate_catalog()
+    return refused
 
 
-def cancel_order(order):
-    """ Set the 'canceled' status for the given Order
+def set_reserve_for_order_items(orders):
+    """ Set the 'reserved' status for products in the given Order(s)."""
+    return change_orders_status(orders, 'RESERVED')
+
+
+def cancel_order(orders):
+    """ Set the 'canceled' status for the given Order(s)
     and remove reserve from all its items"""
-    order_content = order.items.all()
-    for item in order_content:
-        item.product.reserved = False
-        item.product.save()
-    order.status = 'CANCELED'
-    order.save()
-
-
-def progress_order(order):
-    """ Mark the Order as processed by an admin and reserve all items"""
-    order_content = order.items.all()
-    for item in order_content:
-        item.product.reserved = True
-        item.product.save()
-    order.status = 'WIP'
-    order.save()
-
-
-def sell_order(order):
-    """ Set status not in_stock for products in Order"""
-    order_content = order.items.all()
-    for item in order_content:
-        item.product.reserved = False
-        item.product.in_stock = False
-        item.product.save()
-    order.status = 'COMPLETED'
-    order.save()
+    return change_orders_status(orders, 'CANCELED')
+
+
+def progress_order(orders):
+    """ Mark the Order(s) as processed by an admin and reserve all items"""
+    return change_orders_status(orders, 'WIP')
+
+
+def sell_order(orders):
+    """ Set status not in_stock for products in Order(s)"""
+    return change_orders_status(orders, 'COMPLETED')
+
+
+# checkout is repeated when the database was locked by a concurrent one
+# or products were taken by it (databases without row locks)
+CHECKOUT_ATTEMPTS = 3
+CHECKOUT_RETRY_DELAY = 0.05
+
+
+class CheckoutConflict(Exception):
+    """ Concurrent checkouts didn't let to make an order, try again later"""
+
+
+def checkout_cart(cart, on_created=None, **order_fields):
+    """ Create a reserved Order from available products of the Cart.
+    on_created(order) is called in the same transaction (e.g. to queue
+    e-mails). Runs a constant number of queries for any cart size.
+    Returns (order, lost product ids), order is None if nothing to sell.
+    Raises CheckoutConflict if concurrent checkouts didn't let to finish."""
+    if cart.pk is None:
+        # virtual cart has no items
+        return None, set()
+
+    # inside an outer transaction a failed attempt can't be repeated
+    attempts = 1 if connection.in_atomic_block else CHECKOUT_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            order, lost_ids = _checkout_cart(cart, on_created, order_fields)
+            break
+        except (CheckoutConflict, OperationalError) as exc:
+            if attempt == attempts:
+                raise CheckoutConflict('Checkout failed, try again') from exc
+            # random delay: concurrent checkouts don't collide again
+            time.sleep(CHECKOUT_RETRY_DELAY * attempt * random.random())
+
+    if order is not None:
+        cart.status = 'ORDER'
+        # .update() sends no signals: drop cached catalog data explicitly
+        invalidate_catalog()
+    return order, lost_ids
+
+
+def _checkout_cart(cart, on_created, order_fields):
+    """ One attempt of checkout_cart() in a transaction"""
+    with transaction.atomic():
+        # lock the cart first: double submit can't make two orders
+        if not Cart.objects.select_for_update().filter(
+                pk=cart.pk, status='NEW').exists():
+            return None, set()
+        cart_product_ids = CartItem.objects.filter(
+            cart=cart).values('product_id')
+        # lock products of the cart (always in pk order, as in
+        # change_orders_status). The lock waits for concurrent checkouts,
+        # then the condition is checked again on the committed rows.
+        products = list(
+            Product.objects.select_for_update()
+            .filter(pk__in=cart_product_ids, in_stock=True, reserved=False)
+            .order_by('pk')
+        )
+        product_ids = [product.pk for product in products]
+        lost_ids = set(
+            CartItem.objects.filter(cart=cart)
+            .exclude(product_id__in=product_ids)
+            .values_list('product_id', flat=True)
+        )
+        if not products:
+            return None, lost_ids
+
+        # single conditional UPDATE, tutorials stay not reserved
+        # (see ProductQuerySet.update()). Without row locks some products
+        # may be taken meanwhile: roll back, they are lost in next attempt
+        reserved = Product.objects.filter(
+            pk__in=product_ids, in_stock=True, reserved=False,
+        ).update(reserved=True)
+        if reserved != len(products):
+            raise CheckoutConflict('Products were taken by another checkout')
+
+        order = Order.objects.create(
+            cart=cart, status='RESERVED', **order_fields)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price)
+            for product in products
+        ])
+        # .update() skips auto_now, so 'date_updated' is set explicitly
+        Cart.objects.filter(pk=cart.pk).update(
+            status='ORDER', date_updated=timezone.now())
+        if on_created is not None:
+            on_created(order)
+    return order, lost_ids